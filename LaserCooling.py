@@ -4,15 +4,24 @@
 
 # Requires the NumPy and Pygame packages to be installed on your system
 
+import argparse
+import glob
+import heapq
 import os
+import queue
 import sys
+import threading
 
 import pygame
 from pygame.locals import *
 
 import numpy as np
-from random import uniform
-import colorsys
+import random
+import json
+import struct
+import time
+from collections import OrderedDict
+from importlib.util import find_spec
 
 # These two lines are necessary to package the .py file into an executable using PyInstaller,
 # but can be ignored if the script is simply run as Python code
@@ -44,8 +53,27 @@ DARK_GRAY = (79, 79, 79)
 BLACK = (0, 0, 0)
 
 # Gameplay attributes
-FPS = 30  # Framerate
+FPS = 30  # Number of physics steps per second; all speeds are per step, and all times are in steps
+RENDER_FPS = 60  # Maximal number of frames drawn per second
+PHYSICS_TIMESTEP = 1000/FPS  # Duration of one physics step, in milliseconds
+MAX_FRAME_TIME = 250  # If drawing a frame takes longer than this (in milliseconds), the simulation slows down
 ATOM_RADIUS = 16
+PHOTON_WIDTH = 12
+PHOTON_HEIGHT = 8
+PHOTON_HIT_RADIUS = min(PHOTON_WIDTH, PHOTON_HEIGHT)/2  # We use a circular hitbox for the photons
+ATOM_CAPACITY = 256  # The maximal number of atoms and photons on the screen at the same time
+PHOTON_CAPACITY = 1024
+SPRITE_CACHE_MAX_BYTES = 4*1024*1024  # Maximal memory used by the tinted atom images
+TEXT_CACHE_MAX_ENTRIES = 64  # Maximal number of rendered strings that are kept
+# The applet looked up Verdana with pygame.font.SysFont, which was slow and fell back to another font on systems
+# without Verdana. Verdana may not be redistributed, so the applet now comes with DejaVu Sans, a free font of the same
+# style, and the text looks the same on every platform (see fonts/LICENSE_DEJAVU)
+FONT_PATH = 'fonts/DejaVuSans.ttf'
+FONT_SIZE_SMALL = 11  # The text on the sliders
+FONT_SIZE_NORMAL = 18
+FONT_SIZE_LARGE = 24
+FONT_SIZE_OVERLAY = 13  # The frame timings of the FrameProfiler
+COLOR_TABLE_RESOLUTION = 10  # Number of colors per degree of hue in the precomputed color table
 SPEED_OF_LIGHT = 8  # Speed of the photons, in pixels/frame
 ATOM_COLLISION_SPEED_GAIN = 0.175  # The speed an atom gains when a photon collides with it, in pixels/frame
 HUE_MIN = 0.  # Hue of the lowest color on the slider (red)
@@ -59,49 +87,117 @@ SPEED_OF_LIGHT_DOPPLER = 16  # Speed of light used for the Doppler effect, in pi
 FREQ_MIN = SPEED_OF_LIGHT_DOPPLER/700  # Frequency of the lowest color, in arbitrary units
 FREQ_MAX = SPEED_OF_LIGHT_DOPPLER/400  # Frequency of the highest color, in arbitrary units
 
+# An atom is removed when its center is outside these bounds, of the form ((x_min, y_min), (x_max, y_max))
+ATOM_EXIT_BOUNDS = ((LEFT_BORDER - ATOM_RADIUS - 1, TOP_BORDER - ATOM_RADIUS - 1),
+                    (WINDOW_WIDTH - RIGHT_BORDER + ATOM_RADIUS + 1, WINDOW_HEIGHT - BOTTOM_BORDER + ATOM_RADIUS + 1))
+
+# Bin edges of the histograms of the atom velocities, in pixels/step
+VELOCITY_HISTOGRAM_BINS = np.linspace(-2., 2., 41)
+
+# Level 4 is the gas mode ('optical molasses'): instead of a trickle of atoms from the left, the play area is filled
+# with thousands of small atoms with random 2D velocities, that bounce off the walls. Two counter-propagating laser
+# beams as high as the play area slow them down. The laser beams do not get weaker when atoms absorb from them.
+N_LEVELS = 4
+GAS_LEVEL = 4
+GAS_N_ATOMS = 2000
+GAS_ATOM_CAPACITY = 4096
+GAS_ATOM_RADIUS = 3
+GAS_ATOM_DTYPE = np.float32  # The gas has the most atoms, so its positions, velocities and colors are kept in float32
+GAS_VELOCITY_SPREAD = 0.5  # Standard deviation of every velocity component at the start, in pixels/step
+GAS_TEMPERATURE = 300.  # Temperature of the gas at the start in kelvin; this sets the temperature scale of the gas
+GAS_BEAM_SPACING = 8  # Vertical distance between the photons in a laser beam
+# The gas atoms get a smaller kick from every photon than the atoms of levels 1-3, and absorb the photons with a
+# probability that falls off with the difference in hues (a Lorentzian line, see absorb_photons), as real atoms do.
+# Both are needed for a slightly redder laser to cool the gas: with the sharp hue range of levels 1-3, an atom that
+# does not move fast absorbs both lasers equally, and the random kicks only heat it.
+GAS_COLLISION_SPEED_GAIN = 0.05  # In pixels/frame, as ATOM_COLLISION_SPEED_GAIN
+GAS_LINE_WIDTH = 6.  # Difference in hues at which a photon is absorbed half of the time
+
+# Position of the number of atoms on the screen
+SCORE_XY = (LEFT_BORDER + 6, TOP_BORDER + PLAY_HEIGHT + 6)
+
+# Position where the photons leave the laser when it is in the middle of its rail
+LASER_XY_DEFAULT = (WINDOW_WIDTH - RIGHT_BORDER, TOP_BORDER + PLAY_HEIGHT/2)
+
+# The frame profiler keeps the timings of the last PROFILER_CAPACITY drawn frames; its overlay is shown or hidden
+# with PROFILER_KEY, and refreshed every PROFILER_OVERLAY_INTERVAL frames
+PROFILER_CAPACITY = 3600
+PROFILER_KEY = K_F3
+PROFILER_OVERLAY_INTERVAL = 15
+
+# Format of the input logs, see InputRecorder: a header with the seed of the simulation, followed by one record for
+# every drawn frame with the mouse position, the mouse buttons (bit 0: clicked, bit 1: down) and the number of
+# physics steps that were done after the frame
+INPUT_LOG_MAGIC = b'LCIL'
+INPUT_LOG_VERSION = 1
+INPUT_LOG_HEADER = struct.Struct('<4sBQ')  # Magic, version, seed
+INPUT_LOG_FRAME = struct.Struct('<hhBH')  # Mouse x, mouse y, mouse buttons, number of physics steps
+
+# Records of the trajectory files, see TrajectoryWriter. Positions, velocities and hues are stored in single precision
+# to halve the size of the files; that is more than precise enough for pixels.
+PARTICLE_RECORD_DTYPE = np.dtype([('frame', np.int64), ('id', np.int64), ('x', np.float32), ('y', np.float32),
+                                  ('vx', np.float32), ('vy', np.float32), ('hue', np.float32)])
+ABSORPTION_RECORD_DTYPE = np.dtype([('frame', np.int64), ('atom_id', np.int64), ('photon_id', np.int64),
+                                    ('photon_hue', np.float32), ('photon_vx', np.float32), ('x', np.float32),
+                                    ('y', np.float32), ('vx', np.float32), ('vy', np.float32)])
+
 
 # ===== MAIN FUNCTION =====
-def main():
+def main(record_path=None, profile_path=None, trajectory_directory=None, startup_path=None):
+    # The time every part of the startup takes is measured, up to the first frame on the screen. If startup_path is
+    # given, these times are saved to it as JSON, and the applet quits right after the first frame.
+    startup_times = [('start', time.perf_counter())]
+
     # Set up pygame and the display
     pygame.init()
     fps_clock = pygame.time.Clock()
     display_surf = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
     pygame.display.set_caption('Laser cooling')
+    startup_times.append(('display', time.perf_counter()))
 
     # Initialize fonts
-    font_normal = pygame.font.SysFont('verdana', 18)
-    font_large = pygame.font.SysFont('verdana', 24)
+    font_normal = ASSETS.get_font(FONT_SIZE_NORMAL)
+    font_large = ASSETS.get_font(FONT_SIZE_LARGE)
+    startup_times.append(('fonts', time.perf_counter()))
 
     # Initialize some mouse variables
     mouse_xy = (0, 0)
     mouse_is_down = False
 
-    # Create the slider bars, and the buttons to change level
-    slider_intensity = Slider(display_surf, (LEFT_BORDER + 192, WINDOW_HEIGHT-BOTTOM_BORDER + 32,
-                                             WINDOW_WIDTH - RIGHT_BORDER - 192 - (LEFT_BORDER + 192), 12),
-                              'horizontal', (0.5, 2.), None, (16, 24), 'Intensity', font_normal, LIGHT_GRAY)
-    slider_hue = HueSlider(display_surf, (LEFT_BORDER + 192, WINDOW_HEIGHT-BOTTOM_BORDER + 96,
-                                          WINDOW_WIDTH - RIGHT_BORDER - 192 - (LEFT_BORDER + 192), 12),
-                           'horizontal', (HUE_MIN, HUE_MAX), 141., (16, 24), 'Frequency', font_normal, LIGHT_GRAY)
-    button_nextlevel = ImageButton(display_surf, (WINDOW_WIDTH - 80, WINDOW_HEIGHT-80, 64, 64),
-                                   'images/Next_idle.png', 'images/Next_hover.png')
-    button_prevlevel = ImageButton(display_surf, (16, WINDOW_HEIGHT-80, 64, 64),
-                                   'images/Prev_idle.png', 'images/Prev_hover.png')
-
-    # Create the laser
-    laser = Laser(display_surf, (WINDOW_WIDTH - RIGHT_BORDER, TOP_BORDER, 64, PLAY_HEIGHT))
-
-    # Initialize the atom and photon lists
-    atoms = []
-    photons = []
-
-    # Initialize the atom timer
-    atom_timer = (int(max(TIMES_BETWEEN_ATOMS_INITIAL[0]-150, 1)), TIMES_BETWEEN_ATOMS_INITIAL[0])
+    # Create the slider bars, the buttons to change level, and the laser
+    controls = ControlPanel(display_surf, font_normal)
+    startup_times.append(('controls', time.perf_counter()))
+
+    # Create the renderer, which draws everything on the screen
+    renderer = Renderer(display_surf, font_large, font_normal)
+
+    # Create the simulation, which contains the atoms, the photons, and the atom timer
+    # The main loop below is only a viewer: it passes the mouse input to the simulation and draws its state
+    # If the session is recorded, the simulation needs a known seed, so that it can be replayed exactly
+    recorder = None
+    if record_path is not None:
+        seed = random.getrandbits(63)
+        recorder = InputRecorder(record_path, seed)
+        simulation = Simulation(seed=seed)
+    else:
+        simulation = Simulation()
+    # The trajectories are saved without ever letting the applet wait for the disk; if the disk cannot keep up, some
+    # batches of records are dropped (see TrajectoryWriter)
+    if trajectory_directory is not None:
+        simulation.trajectory_writer = TrajectoryWriter(trajectory_directory, block=False)
+
+    # The frame profiler measures how long every part of a frame takes. It is started when the session is profiled,
+    # or when its overlay is shown for the first time.
+    profiler = None
+    show_profiler = False
+    if profile_path is not None:
+        profiler = FrameProfiler()
+        simulation.profiler = profiler
+        renderer.profiler = profiler
 
     # Initialize some other variables
-    current_level = 1
-    hsv_color = None
-    flag_restart = False
+    time_accumulator = 0.  # Time that has passed but has not been simulated yet, in milliseconds
+    fps_clock.tick()
 
     # Main game loop:
     while True:
@@ -109,8 +205,20 @@ def main():
         mouse_is_clicked = False
         for event in pygame.event.get():
             if event.type == QUIT or (event.type == KEYUP and event.key == K_ESCAPE):
+                if recorder is not None:
+                    recorder.close()
+                if profile_path is not None:
+                    profiler.dump(profile_path)
+                if simulation.trajectory_writer is not None:
+                    simulation.trajectory_writer.close()
                 pygame.quit()
                 sys.exit()
+            elif event.type == KEYUP and event.key == PROFILER_KEY:
+                show_profiler = not show_profiler
+                if profiler is None:
+                    profiler = FrameProfiler()
+                    simulation.profiler = profiler
+                    renderer.profiler = profiler
             elif event.type == MOUSEMOTION:
                 mouse_xy = event.pos
             elif event.type == MOUSEBUTTONDOWN and event.button == 1:  # "and" is short-circuited
@@ -122,174 +230,658 @@ def main():
                 mouse_is_clicked = False
                 mouse_is_down = False
         mouse_state = (mouse_xy, mouse_is_clicked, mouse_is_down)
-
-        # Create new atoms with a delay between them
-        atom_timer = run_atom_timer(atoms, atom_timer, current_level, hsv_color)
-
-        # Draw and control everything, first the bottom layers and then the top layers
-        # Draw the gray background:
-        pygame.draw.rect(display_surf, LIGHTISH_GRAY, (0, 0, WINDOW_WIDTH, WINDOW_HEIGHT))
-        # Draw, move, and collide all atoms and photons:
-        for particle in photons+atoms:
-            particle.move()
-            particle.draw(display_surf)
-        for atom in atoms:
-            atom.collide(photons)
-        remove_outside_atoms(atoms)
-        # Draw the gray borders on the edges of the screen:
-        draw_borders(display_surf)
-        # Draw the text on top of the borders:
-        draw_text(display_surf, atoms, font_large, font_normal, current_level)
-
-        # Draw and control the buttons, the slider bars, and the laser
-        # The 'control' function draws the button, and return True if the button is clicked
-        if current_level < 3 and button_nextlevel.control(mouse_state):
-            # "and" is short-circuited, so the button isn't drawn if current_level = 3
-            current_level = min(current_level+1, 3)
-            flag_restart = True
-        if current_level > 1 and button_prevlevel.control(mouse_state):
-            current_level = max(current_level-1, 1)
-            flag_restart = True
-        if current_level > 1:
-            # The 'control' function draws the slider, and returns the value it is currently on
-            color_hue = slider_hue.control(mouse_state)
+        if profiler is not None:
+            profiler.lap('events')
+
+        # Control the buttons, the slider bars, and the laser, and pass their settings to the simulation
+        controls.update(mouse_state, simulation)
+        if profiler is not None:
+            profiler.lap('controls')
+
+        # Draw everything, and update the parts of the screen that changed
+        overlay = None
+        if show_profiler:
+            overlay = profiler.get_overlay(simulation, fps_clock.get_fps())
+        renderer.draw(simulation, simulation.level, controls.visible_widgets(simulation.level), mouse_state,
+                      time_accumulator/PHYSICS_TIMESTEP, overlay)
+        if startup_times is not None:
+            startup_times.append(('first frame', time.perf_counter()))
+            if startup_path is not None:
+                # Quit in the next frame, in the same way as when the window is closed
+                save_startup_times(startup_path, startup_times)
+                pygame.event.post(pygame.event.Event(QUIT))
+            startup_times = None
+
+        # Wait until the next frame, and advance the simulation by all physics steps that fit in the time that passed
+        # On slow hardware, several steps are done before the next frame is drawn; on fast hardware, the particles
+        # are drawn in between two steps, so the simulation runs at the same speed on every machine
+        time_accumulator += min(fps_clock.tick(RENDER_FPS), MAX_FRAME_TIME)
+        if profiler is not None:
+            profiler.lap('wait')
+        n_steps = int(time_accumulator // PHYSICS_TIMESTEP)
+        time_accumulator -= n_steps*PHYSICS_TIMESTEP
+        if recorder is not None:
+            recorder.record(mouse_state, n_steps)
+        # Create new atoms, move and collide all atoms and photons, and fire the laser
+        simulation.step(n_steps)
+        if profiler is not None:
+            profiler.end_frame(n_steps, len(simulation.atoms), len(simulation.photons))
+
+
+def save_startup_times(path, startup_times):
+    # Save the duration of every part of the startup in milliseconds, as JSON, together with the assets that were
+    # loaded; startup_times is a list of (phase, time when the phase ended), starting with ('start', start time)
+    durations = {phase: 1000*(end - start) for (_, start), (phase, end) in zip(startup_times[:-1], startup_times[1:])}
+    durations['total'] = 1000*(startup_times[-1][1] - startup_times[0][1])
+    with open(path, 'w') as startup_file:
+        json.dump({'startup_ms': durations, 'assets': ASSETS.stats()}, startup_file, indent=1)
+
+
+# ===== SIMULATION CORE =====
+class Simulation:
+    # Contains all the physics of the applet: the atoms, the photons, the atom timer, and the firing of the laser
+    # The simulation never touches the display, so it can also run headless (without a window and without waiting
+    # for the frame clock), e.g. for batch demos and regression checks. One call to step() advances it by one frame.
+    # All random numbers come from the simulation's own random generator, so a simulation with a given seed always
+    # gives the same results.
+
+    def __init__(self, level=1, laser_xy=LASER_XY_DEFAULT, laser_hue=140., laser_intensity=1., seed=None,
+                 counter_propagating=True, atom_hue=None):
+        self.level = level
+        self.frame = 0
+        self.rng = random.Random(seed)
+        # Vectorized random numbers (for the gas mode) come from a NumPy generator with the same seed, see get_np_rng
+        self.seed = seed
+        self.np_rng = None
+        self.atoms = AtomPool()
+        self.photons = PhotonPool()
+        self.scheduler = AbsorptionScheduler()  # Predicts the absorptions in levels 1-3
+        self.physics_backend = DEFAULT_PHYSICS_BACKEND  # Finds the absorptions in the gas mode, see collide_atoms
+        self.hsv_color = None
+        self.atom_timer = None
+        # The laser shoots a photon every laser_firing_delay frames, from the position laser_xy
+        self.laser_xy = laser_xy
+        self.laser_hue = laser_hue
+        self.laser_firing_delay = int(FPS/laser_intensity)
+        self.laser_timer = 0
+        # In the gas mode, a second laser on the left shoots at the atoms from the other side
+        self.counter_propagating = counter_propagating
+        # Statistics of what happened to the atoms and photons, see metrics()
+        self.n_photons_absorbed = 0
+        self.n_atoms_escaped = 0  # Atoms that left the play area on the right, past the laser
+        self.n_atoms_returned = 0  # Atoms that were pushed back and left the play area on the left
+        self.exit_velocity_histogram = np.zeros(len(VELOCITY_HISTOGRAM_BINS) - 1, dtype=np.int64)
+        # If a FrameProfiler is set, the time spent in every part of step() is measured
+        self.profiler = None
+        # If a TrajectoryWriter is set, the state of the particles after every step and all absorptions are saved
+        self.trajectory_writer = None
+        # Set up the room of the level, as set_level does (atom_hue is only used in level 3 and in the gas mode)
+        # The atom timer is of the form (timer, max_time), see run_atom_timer; at the start, the first atom comes a
+        # little later than after a restart
+        self.restart(atom_hue)
+        self.atom_timer = (int(max(TIMES_BETWEEN_ATOMS_INITIAL[0]-150, 1)), TIMES_BETWEEN_ATOMS_INITIAL[0])
+
+    def get_np_rng(self):
+        # The NumPy random generator is only created when it is first needed: importing numpy.random takes longer
+        # than the rest of the startup of the applet together, and levels 1-3 do not use it
+        if self.np_rng is None:
+            self.np_rng = np.random.default_rng(self.seed)
+        return self.np_rng
+
+    def set_level(self, level, atom_hue=None):
+        # Changing the level always re-setups the room
+        # In level 3 and in the gas mode, all atoms have the same hue; it is chosen at random unless atom_hue is given
+        self.level = level
+        self.restart(atom_hue)
+
+    def restart(self, atom_hue=None):
+        # Re-setup the room by clearing all particles, and resetting the atom timer
+        # The gas mode needs a larger pool of smaller atoms than the other levels
+        if self.level == GAS_LEVEL:
+            capacity, radius, dtype = GAS_ATOM_CAPACITY, GAS_ATOM_RADIUS, GAS_ATOM_DTYPE
         else:
-            color_hue = 140
-        laser.set_fire_rate(slider_intensity.control(mouse_state))
-        laser.control_shoot(mouse_state, color_hue, photons)
-
-        if flag_restart:
-            # Re-setup the room by clearing all particles, and resetting the atom timer
-            atoms = []
-            photons = []
-            atom_timer = (int(max(TIMES_BETWEEN_ATOMS_INITIAL[0]-100, 1)),
-                          TIMES_BETWEEN_ATOMS_INITIAL[0])
-            if current_level == 3:
-                hsv_color = (int(uniform(80, 240)), 100, 100)
-            else:
-                hsv_color = None
-            flag_restart = False
-
-        # Update the screen and wait until the next step:
-        pygame.display.update()
-        fps_clock.tick(FPS)
-
-
-# ===== CLASSES =====
-class Atom:
-    # An object that represents one atom
-
-    # position and velocity are stored as 2x1 NumPy arrays, but the input can also be in the form of a tuple or a list
-    # Atoms will only absorb a photon if the hue of the atom and the photon are within hue_range of each other
-    # If doppler is set to True, the hue of the atom is corrected for the Doppler effect
-
-    def __init__(self, position=np.array([0, 0]), velocity=np.array([0, 0]), hsv_color=(180, 100, 100), doppler=False,
-                 hue_range=HUE_ABSORPTION_RANGE, image_path='images/Sphere.png', radius=ATOM_RADIUS):
-
-        self.position = np.asarray(position)  # Convert input to an array
-        self.velocity = np.asarray(velocity)  # Convert input to an array
-        self.hsv_color = hsv_color
-        self.rgb_color = hsv_to_rgb_norm(self.hsv_color)
-        self.hue_bare = hsv_color[0]
-        self.hue = self.hue_bare
-        self.hue_range = hue_range
-        self.doppler = doppler
-        self.radius = radius
-        self.image_path = image_path
-        self.image = pygame.transform.scale(pygame.image.load(self.image_path), (2*self.radius, 2*self.radius))
-        self.set_hue(self.hue_bare, self.doppler)
-
-    def set_color(self, color, color_type='hsv'):
-        if color_type.lower() == 'hsv':
-            rgb_color = hsv_to_rgb_norm(color)
-            hsv_color = color
+            capacity, radius, dtype = ATOM_CAPACITY, ATOM_RADIUS, np.float64
+        if self.atoms.capacity != capacity or self.atoms.radius != radius or self.atoms.dtype != dtype:
+            self.atoms = AtomPool(capacity, radius, dtype)
+        self.atoms.clear()
+        self.photons.clear()
+        self.scheduler.reset()
+        self.atom_timer = (int(max(TIMES_BETWEEN_ATOMS_INITIAL[0]-100, 1)), TIMES_BETWEEN_ATOMS_INITIAL[0])
+        if self.level in (3, GAS_LEVEL):
+            if atom_hue is None:
+                atom_hue = int(self.rng.uniform(80, 240))
+            self.hsv_color = (atom_hue, 100, 100)
         else:
-            # We assume the color type is rgb
-            rgb_color = color
-            hsv_color = rgb_to_hsv_norm(color)
-
-        self.hsv_color = hsv_color
-        self.rgb_color = rgb_color
-        color_image = pygame.Surface(self.image.get_size()).convert_alpha()
-        color_image.fill(self.rgb_color)
-        self.image = pygame.transform.scale(pygame.image.load(self.image_path), (2*self.radius, 2*self.radius))
-        self.image.blit(color_image, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
-
-    def set_hue(self, hue, include_doppler=False):
-        # We use this function to change the color of the atom, since we also have to change the variable self.hue
-        # The Doppler effect can also be taken into account through this function
-        if include_doppler:
-            self.hue = hue - \
-                       (1-np.sqrt((1-self.velocity[0]/SPEED_OF_LIGHT_DOPPLER) /
-                                  (1+self.velocity[0]/SPEED_OF_LIGHT_DOPPLER))) * \
-                       (FREQ_MIN/(FREQ_MAX-FREQ_MIN)*(HUE_MAX-HUE_MIN) + hue - HUE_MIN)
+            self.hsv_color = None
+        if self.level == GAS_LEVEL:
+            self.fill_gas()
+
+    def fill_gas(self, n_atoms=GAS_N_ATOMS):
+        # Fill the play area with atoms at random positions, with a Maxwell-Boltzmann distribution of 2D velocities
+        # (every velocity component is normally distributed) at the temperature GAS_TEMPERATURE
+        margin = self.atoms.radius
+        np_rng = self.get_np_rng()
+        positions = np.column_stack((
+            np_rng.uniform(LEFT_BORDER + margin, WINDOW_WIDTH - RIGHT_BORDER - margin, n_atoms),
+            np_rng.uniform(TOP_BORDER + margin, TOP_BORDER + PLAY_HEIGHT - margin, n_atoms)))
+        velocities = np_rng.normal(0., GAS_VELOCITY_SPREAD, (n_atoms, 2))
+        self.atoms.add_many(positions, velocities, self.hsv_color, True, HUE_ABSORPTION_RANGE)
+
+    def set_laser(self, laser_xy=None, hue=None, intensity=None):
+        # Pass the current state of the laser controls to the simulation; None leaves a setting unchanged
+        # The intensity is the fire rate, relative to one photon per second
+        if laser_xy is not None:
+            self.laser_xy = laser_xy
+        if hue is not None:
+            self.laser_hue = hue
+        if intensity is not None:
+            self.laser_firing_delay = int(FPS/intensity)
+
+    def stats(self):
+        # The occupancy of the particle pools
+        return {'atoms': self.atoms.stats(), 'photons': self.photons.stats()}
+
+    def metrics(self):
+        # What happened in the simulation so far: how many photons were absorbed, how many atoms escaped past the
+        # laser or were pushed back, and the distribution of the x-velocities of the atoms when they left the play
+        # area (counts per bin of VELOCITY_HISTOGRAM_BINS)
+        return {'frames': self.frame, 'photons_fired': self.photons.n_added,
+                'photons_absorbed': self.n_photons_absorbed, 'atoms_created': self.atoms.n_added,
+                'atoms_escaped': self.n_atoms_escaped,
+                'atoms_returned': self.n_atoms_returned, 'atoms_remaining': len(self.atoms),
+                'exit_velocity_bins': VELOCITY_HISTOGRAM_BINS.tolist(),
+                'exit_velocity_histogram': self.exit_velocity_histogram.tolist(),
+                'temperature': self.temperature()}
+
+    def temperature(self):
+        # The effective temperature of the atoms along x and along y, from the spread of their velocities, in the
+        # units of the gas mode (the gas starts at GAS_TEMPERATURE)
+        slots = self.atoms.slots()
+        if len(slots) < 2:
+            return 0., 0.
+        variances = np.var(self.atoms.velocities[slots], axis=0)
+        return tuple((GAS_TEMPERATURE*variances/GAS_VELOCITY_SPREAD**2).tolist())
+
+    def record_exits(self, positions, velocities):
+        # Keep statistics of the atoms that left the play area at the given positions with the given velocities
+        self.n_atoms_escaped += int(np.count_nonzero(positions[:, 0] > WINDOW_WIDTH - RIGHT_BORDER))
+        self.n_atoms_returned += int(np.count_nonzero(positions[:, 0] < LEFT_BORDER))
+        bins = np.clip(np.searchsorted(VELOCITY_HISTOGRAM_BINS, velocities[:, 0], side='right') - 1,
+                       0, len(self.exit_velocity_histogram) - 1)
+        np.add.at(self.exit_velocity_histogram, bins, 1)
+
+    def fire_laser(self):
+        # Shoot a photon every laser_firing_delay frames
+        # In the gas mode, the laser shoots a whole column of photons as high as the play area instead, and so does
+        # the laser on the left if counter_propagating is True
+        self.laser_timer = (self.laser_timer + 1) % self.laser_firing_delay
+        if self.laser_timer != 0:
+            return
+        if self.level != GAS_LEVEL:
+            self.photons.add(self.laser_xy, (-SPEED_OF_LIGHT, 0.), self.laser_hue)
+            return
+        y = np.arange(TOP_BORDER + GAS_BEAM_SPACING/2, TOP_BORDER + PLAY_HEIGHT, GAS_BEAM_SPACING)
+        ones = np.ones(len(y))
+        self.photons.add_many(np.column_stack((self.laser_xy[0]*ones, y)),
+                              np.column_stack((-SPEED_OF_LIGHT*ones, 0*ones)), self.laser_hue*ones)
+        if self.counter_propagating:
+            self.photons.add_many(np.column_stack((LEFT_BORDER*ones, y)),
+                                  np.column_stack((SPEED_OF_LIGHT*ones, 0*ones)), self.laser_hue*ones)
+
+    def step(self, n=1):
+        # Advance the simulation by n frames
+        for _ in range(n):
+            self.begin_step()
+            self.photons.move()
+            self.atoms.move()
+            if self.profiler is not None:
+                self.profiler.lap('move')
+            self.end_step()
+
+    def begin_step(self):
+        # The part of a step before the particles move: new atoms are created
+        # In the gas mode, no atoms are created or removed: they bounce off the walls instead
+        if self.level != GAS_LEVEL:
+            self.atom_timer = run_atom_timer(self.atoms, self.atom_timer, self.level, self.hsv_color, self.rng)
+        if self.profiler is not None:
+            self.profiler.lap('atom timer')
+
+    def end_step(self):
+        # The part of a step after the particles moved: collisions, culling, and firing the laser
+        profiler = self.profiler
+        is_gas = self.level == GAS_LEVEL
+        if is_gas:
+            absorbing_atoms, absorbed_photons = collide_atoms(self.atoms, self.photons, True, self.get_np_rng(),
+                                                              self.physics_backend, GAS_COLLISION_SPEED_GAIN,
+                                                              GAS_LINE_WIDTH)
         else:
-            self.hue = hue
-        saturation = self.hsv_color[1]
-        value = self.hsv_color[2]
-        self.set_color((self.hue, saturation, value))
-
-    def move(self):
-        self.position += self.velocity
-
-    def collide(self, photons):
-        # Check for collisions with all photons, and absorb it if the collision goes through
-        for photon in photons:
-            relative_position = self.position - photon.position
-            if relative_position @ relative_position < (self.radius + photon.hit_radius)**2\
-                    and abs(self.hue - photon.hue) < self.hue_range:
-                photons.remove(photon)
-                self.velocity += ATOM_COLLISION_SPEED_GAIN*photon.velocity/np.linalg.norm(photon.velocity)
-                self.set_hue(self.hue_bare, self.doppler)
-
-    def draw(self, surface):
-        # The atom is drawn with its xy-position in the center
-        surface.blit(self.image, tuple(self.position - self.radius))
-
-
-class Photon:
-    # Represents a photon, which comes out of the laser and can collide with atoms
-
-    def __init__(self, position=np.array([0., 0.]), velocity=np.array([0., 0.]), hsv_color=(180, 100, 100),
-                 width=12, height=8):
-        self.position = np.array(position)
-        self.velocity = np.array(velocity)
-        self.hsv_color = hsv_color
-        self.width = width
-        self.height = height
-        self.hit_radius = min(self.width, self.height)/2  # We use a circular hitbox
-        self.hue = hsv_color[0]
+            absorbing_atoms, absorbed_photons = self.scheduler.collide(self.atoms, self.photons, self.frame)
+        self.n_photons_absorbed += len(absorbing_atoms)
+        if self.trajectory_writer is not None and len(absorbing_atoms) > 0:
+            # Right away, before the slots of the absorbed photons are used again
+            self.trajectory_writer.write_absorptions(self, absorbing_atoms, absorbed_photons)
+        if profiler is not None:
+            profiler.lap('collide')
+        if is_gas:
+            reflect_atoms(self.atoms)
+        else:
+            exit_positions, exit_velocities = remove_outside_atoms(self.atoms)
+            if len(exit_positions) > 0:
+                self.record_exits(exit_positions, exit_velocities)
+        remove_outside_photons(self.photons)
+        # One sweep per pool frees the slots of everything that was absorbed or left the play area
+        self.atoms.sweep()
+        self.photons.sweep()
+        if profiler is not None:
+            profiler.lap('culling')
+        self.fire_laser()
+        if profiler is not None:
+            profiler.lap('laser')
+        self.frame += 1
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.write_frame(self)
+
+
+class SimulationBatch:
+    # Several independent simulations in one process that are stepped together, e.g. to show the same level with
+    # different laser settings side by side (see wall.py). The simulations share the caches of the process (ASSETS,
+    # SPRITE_CACHE, TEXT_CACHE and COLOR_TABLE), and the positions and velocities of all their particles are slices
+    # of three shared arrays (one set per dtype of the pools), so that all particles of all simulations move in one
+    # vectorized addition per dtype. The rest of a step is done per simulation, because every simulation has its own
+    # free lists and absorption events.
+    # A simulation gets a new atom pool when it changes to or from the gas mode; the shared arrays are then
+    # allocated again.
+
+    def __init__(self, simulations):
+        self.simulations = list(simulations)
+        self.pools = []  # The pools whose arrays are slices of the shared arrays, in order
+        self.storage = []  # The shared arrays, as a list of (positions, previous_positions, velocities)
+
+    def __len__(self):
+        return len(self.simulations)
+
+    def pack(self):
+        # Move the positions and velocities of all pools into the shared arrays, unless they are already there
+        pools = [pool for simulation in self.simulations for pool in (simulation.atoms, simulation.photons)]
+        if len(pools) == len(self.pools) and all(pool is old_pool for pool, old_pool in zip(pools, self.pools)):
+            return
+        self.storage = []
+        for dtype in sorted(set(pool.dtype for pool in pools), key=str):
+            dtype_pools = [pool for pool in pools if pool.dtype == dtype]
+            n_rows = sum(pool.capacity for pool in dtype_pools)
+            storage = (np.zeros((n_rows, 2), dtype), np.zeros((n_rows, 2), dtype), np.zeros((n_rows, 2), dtype))
+            start = 0
+            for pool in dtype_pools:
+                end = start + pool.capacity
+                pool.use_storage(*(array[start:end] for array in storage))
+                start = end
+            self.storage.append(storage)
+        self.pools = pools
+
+    def step(self, n=1):
+        # Advance all simulations by n frames; the results are the same as calling step(n) on every simulation
+        for _ in range(n):
+            self.pack()
+            for simulation in self.simulations:
+                simulation.begin_step()
+            # The velocities of free slots are 0, so they do not move
+            for positions, previous_positions, velocities in self.storage:
+                previous_positions[:] = positions
+                positions += velocities
+            for simulation in self.simulations:
+                simulation.end_step()
+
+
+# ===== PARTICLE POOLS =====
+class ParticlePool:
+    # A fixed number of particle slots, stored as contiguous NumPy arrays (a 'structure of arrays') instead of one
+    # object per particle. The particle in slot i has position positions[i], velocity velocities[i] and hue hues[i],
+    # and alive[i] tells whether slot i is in use. This way, moving all particles is one vectorized addition,
+    # instead of one small NumPy operation per particle.
+    # All arrays are allocated once. The free slots are kept on a stack (a 'free list'), so adding and removing
+    # particles does not allocate anything, and a particle keeps its slot for its whole life. If the pool is full,
+    # new particles are dropped. Every particle also gets a unique id, to tell it apart from earlier particles
+    # that used the same slot.
+    # During a step, particles are removed in two phases: mark_dead() marks them as dead right away, however often
+    # the same particle is marked, and sweep() then puts all of their slots back on the free list in one pass. This
+    # way, absorbing photons and culling the particles that left the play area cost one sweep per step, instead of
+    # sorting and invalidating the list of slots for every removal.
+    # The positions, velocities and hues are stored as dtype: float64 by default, or float32 to halve the memory of
+    # large pools. The state of one particle takes 66 bytes in float64, and 38 bytes in float32.
+
+    def __init__(self, capacity=256, dtype=np.float64):
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.next_id = 0
+        self.positions = np.zeros((capacity, 2), dtype)
+        self.previous_positions = np.zeros((capacity, 2), dtype)  # The positions before the last call to move()
+        self.velocities = np.zeros((capacity, 2), dtype)
+        self.hues = np.zeros(capacity, dtype)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.dead = np.zeros(capacity, dtype=bool)  # Marked as dead, but not yet swept, see mark_dead()
+        self.n_marked = 0
+        self.free_slots = np.arange(capacity-1, -1, -1, dtype=np.intp)  # The lowest free slot is on top of the stack
+        self.n_free = capacity
+        self.extent = 0  # All slots in use are below this slot
+        self.live_slots = np.zeros(0, dtype=np.intp)  # Sorted list of the slots in use, see slots()
+        self.live_slots_valid = True
+        self.index = None  # Optional spatial index, which is told whenever particles are added or removed
+        # Statistics, see stats()
+        self.high_water = 0
+        self.n_added = 0
+        self.n_removed = 0
+        self.n_dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def array_names(self):
+        # The names of all per-particle arrays; subclasses with extra arrays add their names here
+        return ['positions', 'previous_positions', 'velocities', 'hues', 'alive', 'ids']
+
+    def changed(self):
+        # Called whenever particles are added or removed
+        self.live_slots_valid = False
+        if self.index is not None:
+            self.index.invalidate()
+
+    def slots(self):
+        # Return the slots that are in use, in increasing order
+        if not self.live_slots_valid:
+            self.live_slots = np.flatnonzero(self.alive[:self.extent])
+            self.extent = self.live_slots[-1] + 1 if len(self.live_slots) > 0 else 0
+            self.live_slots_valid = True
+        return self.live_slots
+
+    def add(self, position, velocity, hue):
+        # Add a particle to the pool, and return its slot, or -1 if the pool is full
+        if self.n_free == 0:
+            self.n_dropped += 1
+            return -1
+        self.n_free -= 1
+        index = self.free_slots[self.n_free]
+        self.positions[index] = position
+        self.previous_positions[index] = position
+        self.velocities[index] = velocity
+        self.hues[index] = hue
+        self.alive[index] = True
+        self.ids[index] = self.next_id
+        self.next_id += 1
+        self.count += 1
+        self.n_added += 1
+        self.extent = max(self.extent, index + 1)
+        self.high_water = max(self.high_water, self.count)
+        self.changed()
+        return index
+
+    def add_many(self, positions, velocities, hues):
+        # Add several particles at once, and return their slots; the particles that do not fit are dropped
+        n_added = min(len(positions), self.n_free)
+        self.n_dropped += len(positions) - n_added
+        if n_added == 0:
+            return np.zeros(0, dtype=np.intp)
+        indices = self.free_slots[self.n_free - n_added:self.n_free][::-1].copy()
+        self.n_free -= n_added
+        self.positions[indices] = positions[:n_added]
+        self.previous_positions[indices] = positions[:n_added]
+        self.velocities[indices] = velocities[:n_added]
+        self.hues[indices] = hues[:n_added]
+        self.alive[indices] = True
+        self.ids[indices] = self.next_id + np.arange(n_added)
+        self.next_id += n_added
+        self.count += n_added
+        self.n_added += n_added
+        self.extent = max(self.extent, np.max(indices) + 1)
+        self.high_water = max(self.high_water, self.count)
+        self.changed()
+        return indices
+
+    def use_storage(self, positions, previous_positions, velocities):
+        # Keep the positions and velocities in the given arrays from now on, e.g. slices of larger arrays that are
+        # shared with other pools (see SimulationBatch); their current values are copied into them
+        positions[:] = self.positions
+        previous_positions[:] = self.previous_positions
+        velocities[:] = self.velocities
+        self.positions = positions
+        self.previous_positions = previous_positions
+        self.velocities = velocities
+
+    def mark_dead(self, indices):
+        # Mark the particles in the given slots as dead: they are no longer alive, but their slots are only reused
+        # after the next call to sweep(). Until then, slots() and count still include them.
+        indices = indices[self.alive[indices]]
+        self.alive[indices] = False
+        self.dead[indices] = True
+        self.velocities[indices] = 0.
+        self.n_marked += len(indices)
+
+    def sweep(self):
+        # Put the slots of all particles marked as dead back on the free list, and return these slots
+        if self.n_marked == 0:
+            return np.zeros(0, dtype=np.intp)
+        indices = np.flatnonzero(self.dead[:self.extent])
+        self.dead[indices] = False
+        self.n_marked = 0
+        self.free_slots[self.n_free:self.n_free + len(indices)] = indices
+        self.n_free += len(indices)
+        self.count -= len(indices)
+        self.n_removed += len(indices)
+        self.changed()
+        return indices
+
+    def remove(self, indices):
+        # Remove the particles in the given slots right away, and put the slots back on the free list
+        self.mark_dead(np.asarray(indices, dtype=np.intp))
+        self.sweep()
+
+    def clear(self):
+        self.sweep()
+        self.n_removed += self.count
+        self.alive[:] = False
+        self.velocities[:] = 0.
+        self.free_slots[:] = np.arange(self.capacity-1, -1, -1)
+        self.n_free = self.capacity
+        self.count = 0
+        self.extent = 0
+        self.changed()
 
     def move(self):
-        self.position += self.velocity
-
-    def get_bounding_rectangle(self):
-        return self.position[0] - self.width/2, self.position[1] - self.height/2, self.width, self.height
-
-    def draw(self, surface):
-        fill_color_hsv = self.hsv_color
-        border_color_hsv = (self.hsv_color[0], self.hsv_color[1], self.hsv_color[2]/2)
-        pygame.draw.ellipse(surface, hsv_to_rgb_norm(fill_color_hsv), self.get_bounding_rectangle())
-        pygame.draw.ellipse(surface, hsv_to_rgb_norm(border_color_hsv), self.get_bounding_rectangle(), 1)
+        self.previous_positions[:self.extent] = self.positions[:self.extent]
+        self.positions[:self.extent] += self.velocities[:self.extent]
+
+    def interpolate_positions(self, slots, alpha=1.):
+        # The positions of the particles in the given slots, a fraction alpha of the way from the previous step to
+        # the current step. This is used to draw the particles in between two physics steps.
+        previous_positions = self.previous_positions[slots]
+        return previous_positions + alpha*(self.positions[slots] - previous_positions)
+
+    def stats(self):
+        # The occupancy of the pool: the number of particles in it now and at most, and how many were ever added,
+        # removed, and dropped because the pool was full
+        return {'capacity': self.capacity, 'count': self.count, 'high_water': self.high_water,
+                'added': self.n_added, 'removed': self.n_removed, 'dropped': self.n_dropped}
+
+
+class AtomPool(ParticlePool):
+    # All atoms in the simulation
+    # hues contains the hue at which each atom absorbs, which is the bare hue hues_bare[i] corrected for the Doppler
+    # effect if doppler[i] is True. Photons that fly to the right (from the left laser in the gas mode) see the
+    # opposite Doppler shift, so they are absorbed at hues_opposite[i] instead. Atoms will only absorb a photon if the
+    # hue of the atom and the photon are within hue_ranges[i] of each other. The atoms are drawn with the color
+    # (hues[i], saturations[i], values[i]).
+    # All atoms in a pool have the same radius. An atom takes 107 bytes in float64, and 59 bytes in float32.
+
+    def __init__(self, capacity=ATOM_CAPACITY, radius=ATOM_RADIUS, dtype=np.float64):
+        super().__init__(capacity, dtype)
+        self.radius = radius
+        self.hues_bare = np.zeros(capacity, dtype)
+        self.hues_opposite = np.zeros(capacity, dtype)
+        self.hue_ranges = np.zeros(capacity, dtype)
+        self.saturations = np.zeros(capacity, dtype)
+        self.values = np.zeros(capacity, dtype)
+        self.doppler = np.zeros(capacity, dtype=bool)
+
+    def array_names(self):
+        return super().array_names() + ['hues_bare', 'hues_opposite', 'hue_ranges', 'saturations', 'values',
+                                        'doppler']
+
+    def add(self, position, velocity, hsv_color=(180, 100, 100), doppler=False, hue_range=HUE_ABSORPTION_RANGE):
+        index = super().add(position, velocity, hsv_color[0])
+        if index < 0:
+            return index
+        self.hues_bare[index] = hsv_color[0]
+        self.saturations[index] = hsv_color[1]
+        self.values[index] = hsv_color[2]
+        self.hue_ranges[index] = hue_range
+        self.doppler[index] = doppler
+        self.update_hues([index])
+        return index
+
+    def add_many(self, positions, velocities, hsv_color=(180, 100, 100), doppler=False,
+                 hue_range=HUE_ABSORPTION_RANGE):
+        # Add several atoms of the same kind at once
+        indices = super().add_many(positions, velocities, np.full(len(positions), hsv_color[0]))
+        self.hues_bare[indices] = hsv_color[0]
+        self.saturations[indices] = hsv_color[1]
+        self.values[indices] = hsv_color[2]
+        self.hue_ranges[indices] = hue_range
+        self.doppler[indices] = doppler
+        self.update_hues(indices)
+        return indices
+
+    def update_hues(self, indices):
+        # Recompute the absorption hues of the given atoms, which change with their velocity if doppler is True
+        # This is only needed when the velocity of an atom changes (when it absorbs a photon or bounces off a wall),
+        # so the collisions and the drawing can read hues and hues_opposite without computing them again
+        doppler = self.doppler[indices]
+        hues_bare = self.hues_bare[indices]
+        velocities_x = self.velocities[indices, 0]
+        self.hues[indices] = np.where(doppler, doppler_shifted_hue(hues_bare, velocities_x), hues_bare)
+        self.hues_opposite[indices] = np.where(doppler, doppler_shifted_hue(hues_bare, -velocities_x), hues_bare)
+
+    def absorption_hues(self, indices, photon_velocities_x):
+        # The hues at which the given atoms absorb photons with the given x-velocities
+        return np.where(photon_velocities_x > 0, self.hues_opposite[indices], self.hues[indices])
+
+
+class PhotonPool(ParticlePool):
+    # All photons in the simulation, which come out of the laser and can collide with atoms
+    # Photons are drawn as ellipses of size PHOTON_WIDTH x PHOTON_HEIGHT with color (hues[i], 100, 100),
+    # but use a circular hitbox of radius PHOTON_HIT_RADIUS
+
+    def __init__(self, capacity=PHOTON_CAPACITY, dtype=np.float64):
+        super().__init__(capacity, dtype)
+        self.index = RowIndex(self)
+
+
+# Width of one row in the sorted keys of a RowIndex: larger than any clipped x-coordinate
+ROW_INDEX_ROW_WIDTH = 4*WINDOW_WIDTH
+ROW_INDEX_CHUNK_SIZE = 1024  # The largest number of points that a RowIndex looks up at once
+
+
+class RowIndex:
+    # A spatial index of the particles in a pool, to find the particles near a point without checking all of them
+    # The particles are put in buckets ('rows') of height cell_size according to their y-coordinate, and are sorted
+    # by x-coordinate within each row. This is meant for photons: they never change rows, and all photons that fly
+    # in the same direction move at the same velocity, so their order stays the same while they move. Photons that
+    # fly to the left and to the right are kept in separate rows ('lanes'). The index only has to be rebuilt when
+    # particles are added or removed, and then only once, right before the next query.
+
+    def __init__(self, pool, cell_size=ATOM_RADIUS, y_min=TOP_BORDER, height=PLAY_HEIGHT):
+        self.pool = pool
+        self.cell_size = cell_size
+        self.y_min = y_min
+        self.n_rows = int(np.ceil(height/cell_size))
+        self.order = np.zeros(0, dtype=np.intp)  # Slots of the particles, sorted by row and then by x-coordinate
+        self.rows = np.zeros(0, dtype=np.intp)  # The row of every particle in 'order', plus n_rows if it flies right
+        self.n_lanes = 1
+        self.is_valid = False
+
+    def invalidate(self):
+        self.is_valid = False
+
+    def get_rows(self, y):
+        # Particles above or below the play area are put in the first or last row
+        return np.clip(((np.asarray(y) - self.y_min)//self.cell_size).astype(np.intp), 0, self.n_rows-1)
+
+    def rebuild(self):
+        slots = self.pool.slots()
+        moves_right = self.pool.velocities[slots, 0] > 0
+        self.n_lanes = 2 if np.any(moves_right) else 1
+        rows = self.get_rows(self.pool.positions[slots, 1]) + self.n_rows*moves_right
+        order = np.lexsort((self.pool.positions[slots, 0], rows))
+        self.order = slots[order]
+        self.rows = rows[order]
+        self.is_valid = True
+
+    def sorted_keys(self):
+        # Combine the row and the x-coordinate into one sorted key; this key stays sorted while the particles move
+        # The x-coordinates are clipped so that particles far outside the screen do not end up in the wrong row
+        # The key of the particle in slot order[i] is keys[i]
+        if not self.is_valid:
+            self.rebuild()
+        x = np.clip(self.pool.positions[self.order, 0], -WINDOW_WIDTH, 2*WINDOW_WIDTH)
+        return self.rows*ROW_INDEX_ROW_WIDTH + x
+
+    def query(self, points, reach, chunk_size=ROW_INDEX_CHUNK_SIZE):
+        # Find all pairs (i, j) where particle slot j lies within 'reach' of points[i] in both x and y
+        # Returns two arrays: the point indices i and the particle slots j
+        # The temporary arrays take about 400 bytes per point, so many points (the thousands of atoms of the gas
+        # mode) are looked up in chunks of chunk_size points; the pairs come out in the same order either way
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        keys = self.sorted_keys()
+        if len(points) == 0 or len(self.order) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        if len(points) <= chunk_size:
+            return self.query_chunk(keys, points, reach)
+        chunks = [self.query_chunk(keys, points[start:start + chunk_size], reach)
+                  for start in range(0, len(points), chunk_size)]
+        pair_points = np.concatenate([chunk_points + i*chunk_size for i, (chunk_points, _) in enumerate(chunks)])
+        return pair_points, np.concatenate([chunk_slots for _, chunk_slots in chunks])
+
+    def query_chunk(self, keys, points, reach):
+        # See query; keys are the sorted keys of the particles
+        row_width = ROW_INDEX_ROW_WIDTH
+        # Every point looks in all rows between first_rows and last_rows, in every lane
+        first_rows = self.get_rows(points[:, 1] - reach)
+        last_rows = self.get_rows(points[:, 1] + reach)
+        rows = first_rows[:, np.newaxis] + np.arange(int(2*reach//self.cell_size) + 2)
+        in_reach = rows <= last_rows[:, np.newaxis]
+        if self.n_lanes == 2:
+            rows = np.hstack((rows, rows + self.n_rows))
+            in_reach = np.hstack((in_reach, in_reach))
+        point_indices, row_numbers = np.nonzero(in_reach)
+        bases = rows[point_indices, row_numbers]*row_width
+        x = np.clip(points[point_indices, 0], -WINDOW_WIDTH + reach, 2*WINDOW_WIDTH - reach)
+        starts = np.searchsorted(keys, bases + x - reach)
+        lengths = np.searchsorted(keys, bases + x + reach, side='right') - starts
+        # Expand every range [start, start + length) of sorted particles into separate (point, particle) pairs
+        pair_points = np.repeat(point_indices, lengths)
+        offsets = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        pair_slots = self.order[np.repeat(starts, lengths) + offsets]
+        return pair_points, pair_slots
 
 
 # ===== ATOM CONTROL FUNCTIONS =====
-def create_random_atom(atoms, level=1, hsv_color=None):
+def create_random_atom(atoms, level=1, hsv_color=None, rng=random):
     # Creates an atom on the left side of the screen, with a random y-coordinate and velocity
     # The type of atom depends on the current 'level':
     # - Level 1: Grey atoms that absorb any color of light
     # - Level 2: Randomly colored atoms that only absorb one color
     # - Level 3: Same-colored atoms with the Doppler effect implemented
+    # The random numbers are drawn from rng, which can be a random.Random instance or the random module itself
 
     x = LEFT_BORDER - ATOM_RADIUS
-    y = uniform(TOP_BORDER + ATOM_RADIUS, TOP_BORDER + PLAY_HEIGHT - ATOM_RADIUS)
-    velocity = uniform(0.8, 1.2)
+    y = rng.uniform(TOP_BORDER + ATOM_RADIUS, TOP_BORDER + PLAY_HEIGHT - ATOM_RADIUS)
+    velocity = rng.uniform(0.8, 1.2)
     if level == 1:
         hsv_color = (180, 0, 50)
         hue_range = 360
         with_doppler = False
     elif level == 2:
-        hsv_color = (uniform(HUE_MIN, HUE_MAX), 100, 100)
+        hsv_color = (rng.uniform(HUE_MIN, HUE_MAX), 100, 100)
         hue_range = HUE_ABSORPTION_RANGE
         with_doppler = False
     elif level == 3:
@@ -303,11 +895,10 @@ def create_random_atom(atoms, level=1, hsv_color=None):
         hue_range = 180
         with_doppler = False
 
-    new_atom = Atom(np.array((x, y)), np.array((velocity, 0.)), hsv_color, with_doppler, hue_range)
-    atoms.append(new_atom)
+    atoms.add((x, y), (velocity, 0.), hsv_color, with_doppler, hue_range)
 
 
-def run_atom_timer(atoms, atom_timer, level=1, hsv_color=None):
+def run_atom_timer(atoms, atom_timer, level=1, hsv_color=None, rng=random):
     # This function handles the delay between the atoms.
     # atom_timer is of the form (timer, max_time); an atom is created everytime timer reaches max_time,
     # then the timer is reset to 0
@@ -316,32 +907,621 @@ def run_atom_timer(atoms, atom_timer, level=1, hsv_color=None):
     max_time = atom_timer[1]
     timer = (timer + 1) % max_time
     if timer == 0:
-        create_random_atom(atoms, level, hsv_color)
+        create_random_atom(atoms, level, hsv_color, rng)
         max_time = int(TIMES_BETWEEN_ATOMS_FINAL[level-1] + (max_time - TIMES_BETWEEN_ATOMS_FINAL[level-1])*0.85)
     return timer, max_time
 
 
+def collide_atoms(atoms, photons, optically_thin=False, rng=None, backend=None, speed_gain=ATOM_COLLISION_SPEED_GAIN,
+                  line_width=None):
+    # Check all atoms for collisions with the photons near them, and let the atoms absorb the photons they hit
+    # A photon hits an atom if their distance is less than the sum of their radii, and their hues are within the
+    # hue range of the atom. If several atoms hit the same photon, the atom in the lowest slot absorbs it.
+    # If optically_thin is True (for the gas mode), the photons are not used up: every atom that a photon passed
+    # in the last step absorbs it, so thousands of atoms do not hide each other from the laser.
+    # If rng (a NumPy random generator) is given, the atoms also emit the absorbed photons again, to the left or to
+    # the right at random, which gives them a kick in that direction as well. This random kick heats the atoms a
+    # little, so they can never be cooled completely. (In three dimensions, the photons would be emitted in any
+    # direction, but the lasers only cool the atoms along x, so the atoms would heat up along y.)
+    # Every absorbed or emitted photon changes the speed of the atom by speed_gain. If line_width is given (which
+    # needs rng), a photon that hits an atom is only absorbed with the probability 1/(1 + (d/line_width)**2), where
+    # d is the difference between the hue of the photon and the hue that the atom absorbs.
+    # The hits are found by one of the PHYSICS_BACKENDS (by default DEFAULT_PHYSICS_BACKEND), which all find the
+    # same hits in the same order. In the gas mode, only the atoms that a photon can reach are looked up, see
+    # find_reachable_atoms; the other atoms are dormant in this step.
+    # Returns the slots of the absorbing atoms and of the photons they absorbed (one pair per absorption)
+    no_absorptions = (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+    if atoms.count == 0 or photons.count == 0:
+        return no_absorptions
+    atom_slots = find_reachable_atoms(atoms, photons) if optically_thin else atoms.slots()
+    if len(atom_slots) == 0:
+        return no_absorptions
+    pair_atoms, pair_photons = PHYSICS_BACKENDS[backend or DEFAULT_PHYSICS_BACKEND](atoms, photons, optically_thin,
+                                                                                    atom_slots)
+    if len(pair_atoms) == 0:
+        return no_absorptions
+    return absorb_photons(atoms, photons, pair_atoms, pair_photons, optically_thin, rng, speed_gain, line_width)
+
+
+def find_reachable_atoms(atoms, photons):
+    # The slots of the atoms that a photon can hit in this step of the gas mode, in increasing order
+    # The lasers of the gas mode shoot whole columns of photons (see Simulation.fire_laser), which all have the same
+    # x-coordinate and fly across the play area together, so there are only a few different x-coordinates. Most
+    # atoms are further than the reach of the photon index (see find_hits_numpy) from all of them in x; these atoms
+    # cannot absorb anything in this step, and are skipped by the backends. As the atoms are only skipped when no
+    # photon is near, the same hits are found in the same order as when all atoms are looked up.
+    atom_slots = atoms.slots()
+    photon_x = np.unique(photons.positions[photons.slots(), 0])
+    if len(photon_x) == 0:
+        return atom_slots[:0]
+    reach = atoms.radius + PHOTON_HIT_RADIUS + SPEED_OF_LIGHT
+    atom_x = atoms.positions[atom_slots, 0]
+    # Compare every atom with the nearest photon x-coordinate on both sides
+    right = np.searchsorted(photon_x, atom_x)
+    near_left = np.abs(atom_x - photon_x[np.maximum(right - 1, 0)]) <= reach
+    near_right = np.abs(atom_x - photon_x[np.minimum(right, len(photon_x) - 1)]) <= reach
+    return atom_slots[near_left | near_right]
+
+
+def find_hits_numpy(atoms, photons, optically_thin=False, atom_slots=None):
+    # Find the pairs of atoms and photons that hit each other, see collide_atoms, with vectorized NumPy operations
+    # The photons near every atom are found with the spatial index of the photons
+    # Only the atoms in atom_slots (by default, all atoms) are looked up
+    # Returns the slots of the atoms and of the photons of all hits
+    reach = atoms.radius + PHOTON_HIT_RADIUS
+    if atom_slots is None:
+        atom_slots = atoms.slots()
+    pair_atoms, pair_photons = photons.index.query(atoms.positions[atom_slots],
+                                                   reach + SPEED_OF_LIGHT if optically_thin else reach)
+    pair_atoms = atom_slots[pair_atoms]
+    # Photons that fly to the right see the opposite Doppler shift
+    atom_hues = atoms.absorption_hues(pair_atoms, photons.velocities[pair_photons, 0])
+    hits = np.abs(atom_hues - photons.hues[pair_photons]) < atoms.hue_ranges[pair_atoms]
+    if optically_thin:
+        # The photon passed the atom if the atom lies between the previous and the current position of the photon
+        photon_x = photons.positions[pair_photons, 0]
+        previous_photon_x = photons.previous_positions[pair_photons, 0]
+        atom_x = atoms.positions[pair_atoms, 0]
+        hits &= (np.minimum(photon_x, previous_photon_x) <= atom_x) & \
+                (atom_x < np.maximum(photon_x, previous_photon_x)) & \
+                (np.abs(atoms.positions[pair_atoms, 1] - photons.positions[pair_photons, 1]) < reach)
+    else:
+        relative_positions = atoms.positions[pair_atoms] - photons.positions[pair_photons]
+        hits &= np.sum(relative_positions**2, axis=1) < reach**2
+    return pair_atoms[hits], pair_photons[hits]
+
+
+def find_hits_loop(atom_slots, atom_positions, atom_hues, atom_hues_opposite, atom_hue_ranges, keys, order,
+                   photon_positions, photon_previous_x, photon_velocities_x, photon_hues, y_min, cell_size, n_rows,
+                   n_lanes, reach, optically_thin):
+    # The same search as find_hits_numpy, as plain loops over the atoms and the rows of the photon index (see
+    # RowIndex.query), so that Numba can compile it; the hits come out in the same order, with the same rounding.
+    # It only takes arrays and numbers, and is called through find_hits_numba or find_hits_python.
+    query_reach = reach + SPEED_OF_LIGHT if optically_thin else reach
+    n_hits = 0
+    hit_atoms = np.empty(16, dtype=np.intp)
+    hit_photons = np.empty(16, dtype=np.intp)
+    for atom_slot in atom_slots:
+        atom_x = float(atom_positions[atom_slot, 0])  # As in find_hits_numpy, also for float32 pools
+        atom_y = float(atom_positions[atom_slot, 1])
+        first_row = min(max(int((atom_y - query_reach - y_min)//cell_size), 0), n_rows - 1)
+        last_row = min(max(int((atom_y + query_reach - y_min)//cell_size), 0), n_rows - 1)
+        x = min(max(atom_x, -WINDOW_WIDTH + query_reach), 2*WINDOW_WIDTH - query_reach)
+        for lane in range(n_lanes):
+            for row in range(first_row + lane*n_rows, last_row + lane*n_rows + 1):
+                base = row*ROW_INDEX_ROW_WIDTH
+                start = np.searchsorted(keys, base + x - query_reach)
+                end = np.searchsorted(keys, base + x + query_reach, side='right')
+                for photon_slot in order[start:end]:
+                    # Photons that fly to the right see the opposite Doppler shift
+                    atom_hue = atom_hues_opposite[atom_slot] if photon_velocities_x[photon_slot] > 0 \
+                        else atom_hues[atom_slot]
+                    if not abs(atom_hue - photon_hues[photon_slot]) < atom_hue_ranges[atom_slot]:
+                        continue
+                    photon_x = photon_positions[photon_slot, 0]
+                    photon_y = photon_positions[photon_slot, 1]
+                    if optically_thin:
+                        previous_x = photon_previous_x[photon_slot]
+                        if not (min(photon_x, previous_x) <= atom_x < max(photon_x, previous_x) and
+                                abs(atom_y - photon_y) < reach):
+                            continue
+                    elif not (atom_x - photon_x)**2 + (atom_y - photon_y)**2 < reach**2:
+                        continue
+                    if n_hits == len(hit_atoms):
+                        hit_atoms = np.concatenate((hit_atoms, np.empty_like(hit_atoms)))
+                        hit_photons = np.concatenate((hit_photons, np.empty_like(hit_photons)))
+                    hit_atoms[n_hits] = atom_slot
+                    hit_photons[n_hits] = photon_slot
+                    n_hits += 1
+    return hit_atoms[:n_hits], hit_photons[:n_hits]
+
+
+def make_find_hits(kernel):
+    # Wrap a compiled or plain version of find_hits_loop so that it takes the pools, like find_hits_numpy
+    def find_hits(atoms, photons, optically_thin=False, atom_slots=None):
+        index = photons.index
+        keys = index.sorted_keys()
+        if atom_slots is None:
+            atom_slots = atoms.slots()
+        return kernel(atom_slots, atoms.positions, atoms.hues, atoms.hues_opposite, atoms.hue_ranges, keys,
+                      index.order, photons.positions, photons.previous_positions[:, 0], photons.velocities[:, 0],
+                      photons.hues, float(index.y_min), float(index.cell_size), index.n_rows, index.n_lanes,
+                      float(atoms.radius + PHOTON_HIT_RADIUS), optically_thin)
+    return find_hits
+
+
+find_hits_python = make_find_hits(find_hits_loop)
+find_hits_compiled = None
+
+
+def find_hits_numba(atoms, photons, optically_thin=False, atom_slots=None):
+    # find_hits_loop compiled by Numba. Like numpy.random, Numba is only imported when it is first needed, because
+    # importing it takes longer than the startup of the applet. The first call also compiles the kernel, which takes
+    # a few seconds; the compiled kernel is cached next to this file, so this only happens once.
+    global find_hits_compiled
+    if find_hits_compiled is None:
+        import numba
+        find_hits_compiled = make_find_hits(numba.njit(cache=True)(find_hits_loop))
+    return find_hits_compiled(atoms, photons, optically_thin, atom_slots)
+
+
+# The ways to find the hits in collide_atoms: 'numpy' is always available, 'numba' only if Numba is installed.
+# 'python' runs find_hits_loop without compiling it; it is very slow, but shows that the loops find the same hits
+# as NumPy where Numba is not installed.
+# The applet always uses NumPy: importing Numba and compiling (or loading) the kernel would freeze the window for up
+# to a few seconds when the gas mode starts. Headless runs (sweeps, replays and rendering), which take much longer
+# than that, use HEADLESS_PHYSICS_BACKEND instead, the fastest backend that is installed.
+PHYSICS_BACKENDS = {'numpy': find_hits_numpy, 'python': find_hits_python}
+if find_spec('numba') is not None:
+    PHYSICS_BACKENDS['numba'] = find_hits_numba
+DEFAULT_PHYSICS_BACKEND = 'numpy'
+HEADLESS_PHYSICS_BACKEND = 'numba' if 'numba' in PHYSICS_BACKENDS else 'numpy'
+
+
+def absorb_photons(atoms, photons, pair_atoms, pair_photons, optically_thin=False, rng=None,
+                   speed_gain=ATOM_COLLISION_SPEED_GAIN, line_width=None):
+    # Let the atoms in the slots pair_atoms absorb the photons in the slots pair_photons that hit them, see
+    # collide_atoms. Returns the slots of the absorbing atoms and of the photons they absorbed.
+    # The absorbed photons are only marked as dead; call photons.sweep() to free their slots.
+    if line_width is not None:
+        # The further the hue of a photon is from the hue the atom absorbs, the less likely the photon is absorbed
+        detunings = atoms.absorption_hues(pair_atoms, photons.velocities[pair_photons, 0]) - photons.hues[pair_photons]
+        is_absorbed = rng.random(len(pair_atoms)) < 1/(1 + (detunings/line_width)**2)
+        pair_atoms = pair_atoms[is_absorbed]
+        pair_photons = pair_photons[is_absorbed]
+    if optically_thin:
+        absorbed_photons = pair_photons
+        absorbing_atoms = pair_atoms
+    else:
+        # Sort the hits by photon and then by atom, and keep the first atom for every photon
+        order = np.lexsort((pair_atoms, pair_photons))
+        pair_atoms = pair_atoms[order]
+        pair_photons = pair_photons[order]
+        is_first = np.ones(len(pair_photons), dtype=bool)
+        is_first[1:] = pair_photons[1:] != pair_photons[:-1]
+        absorbed_photons = pair_photons[is_first]
+        absorbing_atoms = pair_atoms[is_first]
+
+    # Each absorbed photon gives the atom a kick in the direction of the photon
+    photon_velocities = photons.velocities[absorbed_photons]
+    kicks = speed_gain*photon_velocities/np.linalg.norm(photon_velocities, axis=1)[:, np.newaxis]
+    if rng is not None:
+        kicks[:, 0] += speed_gain*rng.choice((-1., 1.), len(absorbing_atoms))
+    np.add.at(atoms.velocities, absorbing_atoms, kicks)
+    atoms.update_hues(np.unique(absorbing_atoms))
+    if not optically_thin:
+        photons.mark_dead(absorbed_photons)  # Swept at the end of the step
+    return absorbing_atoms, absorbed_photons
+
+
+class AbsorptionScheduler:
+    # Predicts the absorptions instead of testing every frame which atoms and photons overlap, for levels 1-3
+    # Between two absorptions, every atom and photon moves in a straight line at constant velocity, and the hue at
+    # which an atom absorbs only changes with its velocity. So, as soon as an atom or a photon appears, or an atom
+    # changes velocity, the frame at which it will hit every photon (or atom) can be computed by solving a quadratic
+    # equation. These predicted absorptions ('events') are kept in a heap, sorted by frame and then by atom slot,
+    # and every frame only the events of that frame are handled. When an atom absorbs a photon, its version goes up
+    # and all its older events become invalid; they are skipped when they come up, as are the events of particles
+    # that no longer exist. A photon hits an atom if they overlap at any time during the frame, not only at the end
+    # of it, so fast photons cannot fly through an atom in between two frames.
+
+    def __init__(self):
+        self.events = []  # Heap of (frame, atom slot, photon slot, atom id, atom version, photon id)
+        self.atoms = None  # The atom pool the versions belong to
+        self.atom_versions = np.zeros(0, dtype=np.int64)
+        self.next_atom_id = 0  # Atoms and photons with an id of at least these are new, and have no events yet
+        self.next_photon_id = 0
+
+    def reset(self):
+        self.events = []
+        self.atoms = None
+
+    def schedule(self, atoms, photons, atom_slots, photon_slots, frame, start_time):
+        # Add the events of all pairs of the given atoms and photons
+        # The time is measured in frames, from the end of the current frame; the pairs are only checked from
+        # start_time on (-1 for particles that moved for the first time in this frame, 0 after an absorption)
+        if len(atom_slots) == 0 or len(photon_slots) == 0:
+            return
+        pair_atoms = np.repeat(atom_slots, len(photon_slots))
+        pair_photons = np.tile(photon_slots, len(atom_slots))
+        atom_hues = atoms.absorption_hues(pair_atoms, photons.velocities[pair_photons, 0])
+        in_hue_range = np.abs(atom_hues - photons.hues[pair_photons]) < atoms.hue_ranges[pair_atoms]
+        pair_atoms = pair_atoms[in_hue_range]
+        pair_photons = pair_photons[in_hue_range]
+        # They overlap when |relative_position + relative_velocity*t| < reach, between the roots of a quadratic
+        reach = atoms.radius + PHOTON_HIT_RADIUS
+        relative_positions = atoms.positions[pair_atoms] - photons.positions[pair_photons]
+        relative_velocities = atoms.velocities[pair_atoms] - photons.velocities[pair_photons]
+        a = np.sum(relative_velocities**2, axis=1)
+        b = 2*np.sum(relative_positions*relative_velocities, axis=1)
+        c = np.sum(relative_positions**2, axis=1) - reach**2
+        discriminants = b**2 - 4*a*c
+        moving = a > 0
+        will_hit = np.where(moving, discriminants > 0, c < 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            first_times = np.where(moving, (-b - np.sqrt(np.maximum(discriminants, 0)))/(2*a), -np.inf)
+            last_times = np.where(moving, (-b + np.sqrt(np.maximum(discriminants, 0)))/(2*a), np.inf)
+        will_hit &= last_times > start_time
+        if not np.any(will_hit):
+            return
+        # The absorption happens in the first frame in which they overlap
+        frames = frame + np.maximum(np.floor(first_times[will_hit]) + 1, start_time + 1).astype(np.int64)
+        pair_atoms = pair_atoms[will_hit]
+        pair_photons = pair_photons[will_hit]
+        for event in zip(frames.tolist(), pair_atoms.tolist(), pair_photons.tolist(),
+                         atoms.ids[pair_atoms].tolist(), self.atom_versions[pair_atoms].tolist(),
+                         photons.ids[pair_photons].tolist()):
+            heapq.heappush(self.events, event)
+
+    def collide(self, atoms, photons, frame):
+        # Handle the absorptions of the given frame, after the particles have moved; see collide_atoms
+        # Returns the slots of the absorbing atoms and of the photons they absorbed
+        # Because the overlap is checked during the whole frame, a photon that only grazes the edge of an atom in
+        # between two frames is absorbed, where the older test of the overlap at the end of every frame missed it.
+        # With a laser that stays in place, the results are the same as with that test. When the laser is moved,
+        # some runs differ from it (and sessions recorded before this change may replay differently).
+        if atoms is not self.atoms:
+            self.events = []
+            self.atoms = atoms
+            self.atom_versions = np.zeros(atoms.capacity, dtype=np.int64)
+            self.next_atom_id = 0
+            self.next_photon_id = 0
+        # First predict the events of the new atoms and photons
+        atom_slots = atoms.slots()
+        photon_slots = photons.slots()
+        is_new_atom = atoms.ids[atom_slots] >= self.next_atom_id
+        new_photons = photon_slots[photons.ids[photon_slots] >= self.next_photon_id]
+        self.schedule(atoms, photons, atom_slots[is_new_atom], photon_slots, frame, -1)
+        self.schedule(atoms, photons, atom_slots[~is_new_atom], new_photons, frame, -1)
+        self.next_atom_id = atoms.next_id
+        self.next_photon_id = photons.next_id
+
+        # Then collect the events of this frame that are still valid
+        pair_atoms = []
+        pair_photons = []
+        while len(self.events) > 0 and self.events[0][0] <= frame:
+            _, atom_slot, photon_slot, atom_id, atom_version, photon_id = heapq.heappop(self.events)
+            if atoms.alive[atom_slot] and atoms.ids[atom_slot] == atom_id and \
+                    self.atom_versions[atom_slot] == atom_version and \
+                    photons.alive[photon_slot] and photons.ids[photon_slot] == photon_id:
+                pair_atoms.append(atom_slot)
+                pair_photons.append(photon_slot)
+        if len(pair_atoms) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        absorbing_atoms, absorbed_photons = absorb_photons(atoms, photons, np.array(pair_atoms, dtype=np.intp),
+                                                           np.array(pair_photons, dtype=np.intp))
+
+        # The atoms that absorbed a photon have a new velocity, so their events are predicted again
+        kicked_atoms = np.unique(absorbing_atoms)
+        self.atom_versions[kicked_atoms] += 1
+        photon_slots = photons.slots()
+        self.schedule(atoms, photons, kicked_atoms, photon_slots[photons.alive[photon_slots]], frame, 0)
+        return absorbing_atoms, absorbed_photons
+
+
+def reflect_atoms(atoms):
+    # Let the atoms bounce off the walls of the play area, as in the gas mode
+    slots = atoms.slots()
+    radius = atoms.radius
+    bounced = np.zeros(len(slots), dtype=bool)
+    for axis, low, high in ((0, LEFT_BORDER + radius, WINDOW_WIDTH - RIGHT_BORDER - radius),
+                            (1, TOP_BORDER + radius, TOP_BORDER + PLAY_HEIGHT - radius)):
+        positions = atoms.positions[slots, axis]
+        velocities = atoms.velocities[slots, axis]
+        below = positions < low
+        above = positions > high
+        if not (np.any(below) or np.any(above)):
+            continue
+        atoms.positions[slots, axis] = np.where(below, 2*low - positions, np.where(above, 2*high - positions,
+                                                                                   positions))
+        atoms.velocities[slots, axis] = np.where(below, np.abs(velocities), np.where(above, -np.abs(velocities),
+                                                                                     velocities))
+        if axis == 0:
+            bounced = below | above
+    # The Doppler shift changes when an atom bounces off the left or the right wall
+    if np.any(bounced):
+        atoms.update_hues(slots[bounced])
+
+
 def remove_outside_atoms(atoms):
-    # This function removes any atom that goes outside the screen
-    for atom in atoms:
-        if not (LEFT_BORDER - ATOM_RADIUS - 1 < atom.position[0] < WINDOW_WIDTH - RIGHT_BORDER + ATOM_RADIUS + 1
-                and TOP_BORDER - ATOM_RADIUS - 1 < atom.position[1] < WINDOW_HEIGHT - BOTTOM_BORDER + ATOM_RADIUS + 1):
-            atoms.remove(atom)
+    # This function removes any atom that goes outside the screen: it is marked as dead, until atoms.sweep()
+    # Returns the positions and velocities the removed atoms had
+    slots = atoms.slots()
+    slots = slots[atoms.alive[slots]]
+    positions = atoms.positions[slots]
+    outside = ~np.all((ATOM_EXIT_BOUNDS[0] < positions) & (positions < ATOM_EXIT_BOUNDS[1]), axis=1)
+    outside_slots = slots[outside]
+    exit_positions = atoms.positions[outside_slots]
+    exit_velocities = atoms.velocities[outside_slots]
+    if len(outside_slots) > 0:
+        atoms.mark_dead(outside_slots)
+    return exit_positions, exit_velocities
+
+
+def remove_outside_photons(photons):
+    # This function removes any photon that has left the play area, e.g. on the left side of the screen
+    # The photons are marked as dead, until photons.sweep(); photons that were already marked are skipped
+    slots = photons.slots()
+    x = photons.positions[slots, 0]
+    y = photons.positions[slots, 1]
+    outside = ~((LEFT_BORDER - PHOTON_WIDTH/2 - 1 < x) & (x < WINDOW_WIDTH - RIGHT_BORDER + PHOTON_WIDTH/2 + 1) &
+                (TOP_BORDER - PHOTON_HEIGHT/2 - 1 < y) & (y < WINDOW_HEIGHT - BOTTOM_BORDER + PHOTON_HEIGHT/2 + 1))
+    if np.any(outside):
+        photons.mark_dead(slots[outside])
+
+
+def doppler_shifted_hue(hue, velocity_x):
+    # The hue that an atom with bare hue 'hue' absorbs when it moves with velocity_x toward the laser
+    # This works both on numbers and on NumPy arrays
+    return hue - (1-np.sqrt((1-velocity_x/SPEED_OF_LIGHT_DOPPLER) / (1+velocity_x/SPEED_OF_LIGHT_DOPPLER))) * \
+        (FREQ_MIN/(FREQ_MAX-FREQ_MIN)*(HUE_MAX-HUE_MIN) + hue - HUE_MIN)
 
 
 # ===== COLOR FUNCTIONS =====
 
 
-def rgb_to_hsv_norm(hsv_color):
+def rgb_to_hsv_norm(rgb_color):
     # This function transforms a (255, 255, 255) rgb color to a (360, 100, 100) hsv color
-    norm_hsv_color = colorsys.rgb_to_hsv(hsv_color[0] / 255.0, hsv_color[1] / 255.0, hsv_color[2] / 255.0)
-    return int(norm_hsv_color[0] * 360), int(norm_hsv_color[0] * 100), int(norm_hsv_color[0] * 100)
+    hsv_color = rgb_to_hsv_array(np.asarray(rgb_color, dtype=float))
+    return int(hsv_color[0]), int(hsv_color[1]), int(hsv_color[2])
 
 
-def hsv_to_rgb_norm(rgb_color):
+def hsv_to_rgb_norm(hsv_color):
     # This function transforms a (360, 100, 100) hsv color to a (255, 255, 255) rgb color
-    norm_rgb_color = colorsys.hsv_to_rgb(rgb_color[0] / 360.0, rgb_color[1] / 100.0, rgb_color[2] / 100.0)
-    return int(norm_rgb_color[0] * 255), int(norm_rgb_color[1] * 255), int(norm_rgb_color[2] * 255)
+    return tuple(COLOR_TABLE.lookup(hsv_color[0], hsv_color[1], hsv_color[2]).tolist())
+
+
+def hsv_to_rgb_array(hue, saturation=100., value=100.):
+    # Vectorized version of colorsys.hsv_to_rgb: transforms (360, 100, 100) hsv colors to (1, 1, 1) rgb colors
+    # The inputs can be numbers or NumPy arrays; the output has an extra last axis for the red, green and blue part
+    sextant = 6*np.mod(np.asarray(hue, dtype=float)/360, 1)[..., np.newaxis]
+    pure_rgb = np.clip(np.abs(sextant - (3, 2, 4))*(1, -1, -1) + (-1, 2, 2), 0, 1)  # Colors with s = v = 100
+    saturation = np.asarray(saturation, dtype=float)[..., np.newaxis]/100
+    value = np.asarray(value, dtype=float)[..., np.newaxis]/100
+    return value*(1 - saturation*(1 - pure_rgb))
+
+
+def rgb_to_hsv_array(rgb):
+    # Vectorized version of colorsys.rgb_to_hsv: transforms (255, 255, 255) rgb colors, given along the last axis,
+    # to (360, 100, 100) hsv colors
+    rgb = np.asarray(rgb, dtype=float)/255
+    maximum = np.max(rgb, axis=-1)
+    spread = maximum - np.min(rgb, axis=-1)
+    safe_spread = np.where(spread > 0, spread, 1)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    hue = np.where(maximum == red, (green - blue)/safe_spread,
+                   np.where(maximum == green, 2 + (blue - red)/safe_spread, 4 + (red - green)/safe_spread))
+    hue = np.where(spread > 0, np.mod(60*hue, 360), 0)
+    saturation = np.where(maximum > 0, 100*spread/np.where(maximum > 0, maximum, 1), 0)
+    return np.stack((hue, saturation, 100*maximum), axis=-1)
+
+
+class ColorTable:
+    # A precomputed table of the fully saturated color of every hue, so that converting a hue to an rgb color is an
+    # array lookup instead of a colorsys call. The table covers the whole color circle (Doppler-shifted hues can lie
+    # outside the range of the hue slider) in steps of 1/resolution degrees; hues outside [0, 360) wrap around.
+    # Other saturations and values are computed from the fully saturated color, which also works on whole arrays.
+
+    def __init__(self, resolution=COLOR_TABLE_RESOLUTION):
+        self.resolution = resolution
+        self.pure_colors = hsv_to_rgb_array(np.arange(360*resolution)/resolution)
+
+    def lookup(self, hue, saturation=100., value=100.):
+        # Returns the (255, 255, 255) rgb colors of the given (360, 100, 100) hsv colors as a uint8 array
+        # The inputs can be numbers or NumPy arrays; the output has an extra last axis for the red, green and blue part
+        indices = np.mod(np.rint(np.asarray(hue)*self.resolution).astype(np.intp), len(self.pure_colors))
+        saturation = np.asarray(saturation, dtype=float)[..., np.newaxis]/100
+        value = np.asarray(value, dtype=float)[..., np.newaxis]/100
+        rgb = value*(1 - saturation*(1 - self.pure_colors[indices]))
+        return (255*rgb).astype(np.uint8)
+
+
+# The color table is shared by the whole process
+COLOR_TABLE = ColorTable()
+
+
+# ===== ASSETS =====
+class Assets:
+    # Loads every image and font of the applet exactly once, and keeps them for the whole process
+    # Several widgets use the same files (the two lasers, and the hover and down images of the buttons), and the
+    # scaled and flipped versions are kept as well, so no file is read or scaled twice. The fonts are loaded from
+    # font_path, instead of looked up with pygame.font.SysFont: that scans all fonts on the system (with fc-list on
+    # Linux), which can take longer than the rest of the startup together.
+
+    def __init__(self, font_path=FONT_PATH):
+        self.font_path = font_path
+        self.images = {}  # Of the form {(image_path, size, flipped): image}, with size None for the original size
+        self.fonts = {}  # Of the form {size: font}
+        self.n_files_loaded = 0
+
+    def get_image(self, image_path, size=None, flipped=False):
+        # The image from image_path, scaled to size (width, height), and mirrored left to right if flipped is True
+        if size is not None:
+            size = (int(size[0]), int(size[1]))
+        key = (image_path, size, flipped)
+        image = self.images.get(key)
+        if image is None:
+            if flipped:
+                image = pygame.transform.flip(self.get_image(image_path, size), True, False)
+            elif size is not None:
+                image = pygame.transform.scale(self.get_image(image_path), size)
+            else:
+                image = pygame.image.load(image_path)
+                self.n_files_loaded += 1
+            self.images[key] = image
+        return image
+
+    def get_font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            font = pygame.font.Font(self.font_path, size)
+            self.fonts[size] = font
+        return font
+
+    def stats(self):
+        return {'images': len(self.images), 'files_loaded': self.n_files_loaded, 'fonts': len(self.fonts)}
+
+
+# The images and fonts are shared by the whole process
+ASSETS = Assets()
+
+
+# ===== IMAGE CACHE =====
+class SpriteCache:
+    # A cache of the tinted atom images and the pre-rendered photons, so that recoloring an atom (e.g. after every
+    # absorption in Doppler mode) does not load, scale and tint Sphere.png again in the middle of a frame, and
+    # photons are blitted instead of drawn as ellipses.
+    # The colors are quantized in steps of hue_step, saturation_step and value_step, and the images are kept in
+    # least-recently-used order. When they take up more than max_bytes, the least recently used ones are removed.
+    # The untinted base images are kept by ASSETS.
+
+    def __init__(self, max_bytes=SPRITE_CACHE_MAX_BYTES, hue_step=1., saturation_step=1., value_step=1.):
+        self.max_bytes = max_bytes
+        self.hue_step = hue_step
+        self.saturation_step = saturation_step
+        self.value_step = value_step
+        # Quantized saturations and values are below code_base, see pack_hsv
+        self.code_base = int(np.rint(100/min(saturation_step, value_step))) + 1
+        self.tinted_images = OrderedDict()  # Of the form {key: image}, oldest first
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_base_image(self, image_path, radius):
+        # The image from image_path, scaled to a square with sides 2*radius
+        return ASSETS.get_image(image_path, (2*radius, 2*radius))
+
+    def quantize_hsv(self, hue, saturation=None, value=None):
+        # Round hsv colors to the steps of the cache; works on numbers and on NumPy arrays
+        # If only the hue is given, only the quantized hue is returned; otherwise the quantized colors are stacked
+        # along the last axis
+        hue = np.rint(np.asarray(hue)/self.hue_step).astype(int)
+        if saturation is None:
+            return hue
+        saturation = np.rint(np.asarray(saturation)/self.saturation_step).astype(int)
+        value = np.rint(np.asarray(value)/self.value_step).astype(int)
+        return np.stack((hue, saturation, value), axis=-1)
+
+    def pack_hsv(self, quantized_hsv):
+        # Pack colors quantized by quantize_hsv into one integer each, so that the distinct colors of many atoms can
+        # be found by sorting a flat array; unpack_hsv does the reverse
+        hue, saturation, value = np.moveaxis(quantized_hsv, -1, 0)
+        return (hue*self.code_base + saturation)*self.code_base + value
+
+    def unpack_hsv(self, code):
+        return code//self.code_base**2, code//self.code_base % self.code_base, code % self.code_base
+
+    def get_atom_image(self, quantized_hsv, radius=ATOM_RADIUS, image_path='images/Sphere.png'):
+        # The image from image_path, scaled and multiplied with a color quantized by quantize_hsv
+        key = (image_path, radius) + tuple(quantized_hsv)
+        image = self.lookup(key)
+        if image is None:
+            hue, saturation, value = quantized_hsv
+            image = self.get_base_image(image_path, radius).copy()
+            color_image = pygame.Surface(image.get_size(), pygame.SRCALPHA)
+            color_image.fill(hsv_to_rgb_norm((hue*self.hue_step, saturation*self.saturation_step,
+                                              value*self.value_step)))
+            image.blit(color_image, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
+            self.store(key, image)
+        return image
+
+    def get_photon_image(self, quantized_hue):
+        # A photon: an ellipse with a darker border, in a hue quantized by quantize_hsv
+        key = ('photon', quantized_hue)
+        image = self.lookup(key)
+        if image is None:
+            hue = quantized_hue*self.hue_step
+            image = pygame.Surface((PHOTON_WIDTH, PHOTON_HEIGHT), pygame.SRCALPHA)
+            pygame.draw.ellipse(image, hsv_to_rgb_norm((hue, 100, 100)), (0, 0, PHOTON_WIDTH, PHOTON_HEIGHT))
+            pygame.draw.ellipse(image, hsv_to_rgb_norm((hue, 100, 50)), (0, 0, PHOTON_WIDTH, PHOTON_HEIGHT), 1)
+            self.store(key, image)
+        return image
+
+    def lookup(self, key):
+        image = self.tinted_images.get(key)
+        if image is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.tinted_images.move_to_end(key)
+        return image
+
+    def store(self, key, image):
+        self.tinted_images[key] = image
+        self.n_bytes += image.get_width()*image.get_height()*image.get_bytesize()
+        while self.n_bytes > self.max_bytes and len(self.tinted_images) > 1:
+            _, old_image = self.tinted_images.popitem(last=False)
+            self.n_bytes -= old_image.get_width()*old_image.get_height()*old_image.get_bytesize()
+            self.evictions += 1
+
+    def clear(self):
+        self.tinted_images.clear()
+        self.n_bytes = 0
+
+    def stats(self):
+        return {'images': len(self.tinted_images), 'bytes': self.n_bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class TextCache:
+    # A cache of rendered text, so that drawing a string that was drawn before only costs a blit
+    # The rendered strings are keyed by (font, string, color), and kept in least-recently-used order. At most
+    # max_entries strings are kept; the least recently used ones are removed first.
+
+    def __init__(self, max_entries=TEXT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.images = OrderedDict()  # Of the form {(font, string, color): image}, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, string, color):
+        key = (font, string, color)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return image
+        self.misses += 1
+        image = font.render(string, True, color)
+        self.images[key] = image
+        if len(self.images) > self.max_entries:
+            self.images.popitem(last=False)
+        return image
+
+    def clear(self):
+        self.images.clear()
+
+    def stats(self):
+        return {'images': len(self.images), 'max_entries': self.max_entries, 'hits': self.hits,
+                'misses': self.misses}
+
+
+# The tinted atom images and the rendered text are shared by the whole process
+SPRITE_CACHE = SpriteCache()
+TEXT_CACHE = TextCache()
 
 
 # ===== DRAW FUNCTIONS =====
@@ -356,29 +1536,549 @@ def draw_borders(surface):
     pygame.draw.rect(surface, BLACK, (LEFT_BORDER, TOP_BORDER, PLAY_WIDTH, PLAY_HEIGHT), 1)
 
 
-def draw_text(surface, atoms, title_font, score_font, level):
-    # Draw all the necessary text on the screen
-
-    # Title
+def draw_particles(surface, atoms, photons, alpha=1.):
+    # Draw all photons, and then all atoms on top of them, with a single Surface.blits call
+    # The particles are drawn a fraction alpha of the way between the previous and the current physics step
+    # Particles with the same (quantized) color share one pre-rendered image from the sprite cache, so there is only
+    # one cache lookup per color instead of one per particle, and an atom is only tinted again when its quantized
+    # color changes to one that is not in the cache
+    # Returns the list of rectangles that were drawn on
+    blit_sequence = []
+    slots = photons.slots()
+    if len(slots) > 0:
+        colors, which_color = np.unique(SPRITE_CACHE.quantize_hsv(photons.hues[slots]), return_inverse=True)
+        images = [SPRITE_CACHE.get_photon_image(color) for color in colors.tolist()]
+        # The photons are drawn with their xy-position in the center
+        corners = (photons.interpolate_positions(slots, alpha) - (PHOTON_WIDTH/2, PHOTON_HEIGHT/2)).astype(int).tolist()
+        blit_sequence += zip([images[i] for i in which_color.ravel().tolist()], corners)
+    slots = atoms.slots()
+    if len(slots) > 0:
+        colors, which_color = np.unique(SPRITE_CACHE.pack_hsv(SPRITE_CACHE.quantize_hsv(
+            atoms.hues[slots], atoms.saturations[slots], atoms.values[slots])), return_inverse=True)
+        images = [SPRITE_CACHE.get_atom_image(SPRITE_CACHE.unpack_hsv(color), atoms.radius)
+                  for color in colors.tolist()]
+        # The atoms are drawn with their xy-position in the center
+        corners = (atoms.interpolate_positions(slots, alpha) - atoms.radius).astype(int).tolist()
+        blit_sequence += zip([images[i] for i in which_color.ravel().tolist()], corners)
+    return surface.blits(blit_sequence)
+
+
+def draw_title(surface, title_font, level):
+    # Draw the title at the top of the screen
     if level == 1:
         title_string = 'Laser cooling'
     elif level == 2:
         title_string = 'Laser cooling with different atoms'
     elif level == 3:
         title_string = 'Laser cooling with the Doppler effect'
+    elif level == GAS_LEVEL:
+        title_string = 'Laser cooling of a gas: optical molasses'
     else:
         title_string = 'Laser cooling with a person who broke the applet'
-    title_text = title_font.render(title_string, True, LIGHT_GRAY)
-    title_text_size = title_font.size(title_string)
+    title_text = TEXT_CACHE.render(title_font, title_string, LIGHT_GRAY)
+    title_text_size = title_text.get_size()
     title_text_xy = ((WINDOW_WIDTH - title_text_size[0]) / 2,
                      (TOP_BORDER - title_text_size[1]) / 2)
     surface.blit(title_text, title_text_xy)
 
-    # Number of atoms
-    score_string = 'Atoms: '+str(len(atoms))
-    score_text = score_font.render(score_string, True, LIGHT_GRAY)
-    score_text_xy = (LEFT_BORDER + 6, TOP_BORDER + PLAY_HEIGHT + 6)
-    surface.blit(score_text, score_text_xy)
+
+def render_score(n_atoms, score_font):
+    # Render the number of atoms; returns the image and the position where it should be drawn
+    score_string = 'Atoms: '+str(n_atoms)
+    return TEXT_CACHE.render(score_font, score_string, LIGHT_GRAY), SCORE_XY
+
+
+# ===== RENDERER =====
+class Renderer:
+    # Draws the applet using 'dirty rectangles': instead of repainting the whole window every frame, only the parts
+    # of the screen that changed are redrawn and sent to the display.
+    # Everything that never moves (the borders, the title, the slider bars and their text) is drawn once on a cached
+    # background. Every frame, the rectangles the particles and the moving parts of the widgets ('sprites') covered
+    # in the previous frame are restored from the background, the new ones are drawn, and only this list of
+    # rectangles is passed to pygame.display.update. The background is redrawn when the level or the visible
+    # widgets change. With more than max_particle_rects particles (e.g. in the gas mode), it is faster to restore
+    # and update the whole play area at once than every particle on its own.
+
+    def __init__(self, surface, title_font, score_font, max_particle_rects=256):
+        self.surface = surface
+        self.max_particle_rects = max_particle_rects
+        self.title_font = title_font
+        self.score_font = score_font
+        self.background = pygame.Surface(surface.get_size())
+        self.background_key = None  # The level and the visible widgets the background was drawn for
+        self.particle_rects = []  # The rectangles the particles were drawn on in the previous frame
+        self.sprites = {}  # Of the form {key: (image, xy)}, for the sprites drawn in the previous frame
+        self.score = None  # The number of atoms and its rendered text, of the form (n_atoms, (image, xy))
+        self.overlay_rect = None  # The rectangle the overlay was drawn on in the previous frame
+        self.profiler = None  # If a FrameProfiler is set, the drawing and the display update are timed
+        # If update_display is False, draw() only draws on the surface (e.g. a tile of a larger window, see wall.py),
+        # and the caller updates the display
+        self.update_display = True
+        # The particles are only drawn inside the black line around the play area
+        self.play_rect = pygame.Rect(LEFT_BORDER + 1, TOP_BORDER + 1, PLAY_WIDTH - 2, PLAY_HEIGHT - 2)
+
+    def invalidate(self):
+        # Redraw the background and the whole screen in the next frame
+        self.background_key = None
+
+    def draw_background(self, level, widgets):
+        pygame.draw.rect(self.background, LIGHTISH_GRAY, (0, 0, WINDOW_WIDTH, WINDOW_HEIGHT))
+        draw_borders(self.background)
+        draw_title(self.background, self.title_font, level)
+        for widget in widgets:
+            widget.draw_track(self.background)
+
+    def restore(self, rect):
+        self.surface.blit(self.background, rect, rect)
+
+    def draw(self, simulation, level, widgets, mouse_state, alpha=1., overlay=None):
+        # Draw one frame, and update the parts of the display that changed
+        # The particles are drawn a fraction alpha of the way between the previous and the current physics step
+        # overlay is None or of the form (image, xy); it is drawn on top of the play area, and redrawn every frame
+        # Returns the list of rectangles of the surface that changed
+        background_key = (level, tuple(id(widget) for widget in widgets))
+        full_update = background_key != self.background_key
+        if full_update:
+            self.draw_background(level, widgets)
+            self.surface.blit(self.background, (0, 0))
+            self.background_key = background_key
+            self.particle_rects = []
+            self.sprites = {}
+            self.overlay_rect = None
+
+        sprites = {id(widget): widget.get_sprite(mouse_state) for widget in widgets}
+        # The number of atoms is only rendered again when it changes
+        if self.score is None or self.score[0] != len(simulation.atoms):
+            self.score = (len(simulation.atoms), render_score(len(simulation.atoms), self.score_font))
+        sprites['score'] = self.score[1]
+        changed_sprites = [key for key in sprites if self.sprites.get(key) != sprites[key]]
+        dirty_rects = []
+
+        # First erase everything that moved since the previous frame
+        if len(self.particle_rects) > self.max_particle_rects:
+            self.restore(self.play_rect)
+            dirty_rects.append(self.play_rect)
+        else:
+            for rect in self.particle_rects:
+                self.restore(rect)
+                dirty_rects.append(rect)
+        if self.overlay_rect is not None:
+            self.restore(self.overlay_rect)
+            dirty_rects.append(self.overlay_rect)
+            self.overlay_rect = None
+        for key, (image, xy) in self.sprites.items():
+            if key in changed_sprites or key not in sprites:
+                rect = pygame.Rect(xy, image.get_size())
+                self.restore(rect)
+                dirty_rects.append(rect)
+
+        # Then draw it in its new place
+        self.surface.set_clip(self.play_rect)
+        self.particle_rects = draw_particles(self.surface, simulation.atoms, simulation.photons, alpha)
+        self.surface.set_clip(None)
+        if len(self.particle_rects) > self.max_particle_rects:
+            dirty_rects.append(self.play_rect)
+        else:
+            dirty_rects.extend(self.particle_rects)
+        for key in changed_sprites:
+            image, xy = sprites[key]
+            dirty_rects.append(self.surface.blit(image, xy))
+        self.sprites = sprites
+        if overlay is not None:
+            self.surface.set_clip(self.play_rect)
+            self.overlay_rect = self.surface.blit(*overlay)
+            self.surface.set_clip(None)
+            dirty_rects.append(self.overlay_rect)
+        if self.profiler is not None:
+            self.profiler.lap('draw')
+
+        if full_update:
+            dirty_rects = [self.surface.get_rect()]
+        if self.update_display:
+            pygame.display.update(dirty_rects)
+        if self.profiler is not None:
+            self.profiler.lap('display update')
+        return dirty_rects
+
+
+# ===== FRAME PROFILER =====
+class FrameProfiler:
+    # Measures how long every part ('phase') of a frame takes, to find out which part is too slow when the applet
+    # stutters. Call lap(phase) at the end of every phase: the time since the previous lap is added to that phase of
+    # the current frame. The physics phases are summed over all physics steps of the frame. end_frame() stores the
+    # frame in a ring buffer with the timings of the last 'capacity' frames, in milliseconds.
+
+    PHASES = ('events', 'controls', 'draw', 'display update', 'wait', 'atom timer', 'move', 'collide', 'culling',
+              'laser')
+    WORK_PHASES = tuple(phase for phase in PHASES if phase != 'wait')  # The phases that count for the time budget
+
+    def __init__(self, capacity=PROFILER_CAPACITY):
+        self.capacity = capacity
+        self.phase_indices = {phase: i for i, phase in enumerate(self.PHASES)}
+        self.timings = np.zeros((capacity, len(self.PHASES)))  # Of the form [frame % capacity, phase]
+        # Per frame: the number of physics steps, atoms and photons
+        self.counts = np.zeros((capacity, 3), dtype=np.int64)
+        self.current_timings = np.zeros(len(self.PHASES))
+        self.n_frames = 0
+        self.last_time = time.perf_counter()
+        self.overlay = None  # The rendered overlay, of the form (frame, (image, xy)), see get_overlay
+        self.overlay_font = None
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.current_timings[self.phase_indices[phase]] += 1000*(now - self.last_time)
+        self.last_time = now
+
+    def end_frame(self, n_steps=0, n_atoms=0, n_photons=0):
+        row = self.n_frames % self.capacity
+        self.timings[row] = self.current_timings
+        self.counts[row] = (n_steps, n_atoms, n_photons)
+        self.current_timings[:] = 0.
+        self.n_frames += 1
+
+    def recent_timings(self):
+        # The timings and counts in the ring buffer, oldest frame first, and the number of the first frame
+        n_stored = min(self.n_frames, self.capacity)
+        order = np.arange(self.n_frames - n_stored, self.n_frames) % self.capacity
+        return self.timings[order], self.counts[order], self.n_frames - n_stored
+
+    def summary(self, budget=PHYSICS_TIMESTEP):
+        # The mean and the 99th percentile of every phase, and how many frames took longer than the budget without
+        # counting the time spent waiting for the next frame
+        timings, counts, first_frame = self.recent_timings()
+        if len(timings) == 0:
+            return {'frames': 0}
+        work = timings[:, [self.phase_indices[phase] for phase in self.WORK_PHASES]].sum(axis=1)
+        return {'frames': len(timings),
+                'mean_ms': dict(zip(self.PHASES, np.mean(timings, axis=0).tolist())),
+                'p99_ms': dict(zip(self.PHASES, np.percentile(timings, 99, axis=0).tolist())),
+                'work_mean_ms': float(np.mean(work)), 'work_p99_ms': float(np.percentile(work, 99)),
+                'work_max_ms': float(np.max(work)), 'budget_ms': budget,
+                'frames_over_budget': int(np.count_nonzero(work > budget))}
+
+    def dump(self, path):
+        # Save the timings of the frames in the ring buffer to a CSV file, or a JSON file if path ends in .json
+        timings, counts, first_frame = self.recent_timings()
+        frames = np.arange(first_frame, first_frame + len(timings))
+        if path.lower().endswith('.json'):
+            with open(path, 'w') as dump_file:
+                json.dump({'phases': self.PHASES, 'first_frame': first_frame, 'timings_ms': timings.tolist(),
+                           'steps_atoms_photons': counts.tolist(), 'summary': self.summary()}, dump_file)
+        else:
+            np.savetxt(path, np.column_stack((frames, counts, timings)), delimiter=',',
+                       fmt=['%d']*4 + ['%.4f']*len(self.PHASES), comments='',
+                       header=','.join(('frame', 'steps', 'atoms', 'photons') + self.PHASES))
+
+    def get_overlay(self, simulation, fps):
+        # Returns the overlay with the frame rate, the timings, the particle counts and the cache hit rates, of the
+        # form (image, xy). It is only rendered again every PROFILER_OVERLAY_INTERVAL frames.
+        if self.overlay is not None and self.n_frames - self.overlay[0] < PROFILER_OVERLAY_INTERVAL:
+            return self.overlay[1]
+        if self.overlay_font is None:
+            self.overlay_font = ASSETS.get_font(FONT_SIZE_OVERLAY)
+        summary = self.summary()
+        sprite_stats = SPRITE_CACHE.stats()
+        text_stats = TEXT_CACHE.stats()
+        lines = ['{:.0f} FPS, atoms {}, photons {}'.format(fps, len(simulation.atoms), len(simulation.photons)),
+                 'sprite cache {:.0%} hits, text cache {:.0%} hits'.format(
+                     sprite_stats['hits']/max(sprite_stats['hits'] + sprite_stats['misses'], 1),
+                     text_stats['hits']/max(text_stats['hits'] + text_stats['misses'], 1))]
+        if summary['frames'] > 0:
+            lines.append('frame {:.2f} ms (p99 {:.2f}, max {:.2f}), {} over {:.0f} ms'.format(
+                summary['work_mean_ms'], summary['work_p99_ms'], summary['work_max_ms'],
+                summary['frames_over_budget'], summary['budget_ms']))
+            lines += ['{:>15}: {:6.2f} ms  p99 {:6.2f}'.format(
+                phase, summary['mean_ms'][phase], summary['p99_ms'][phase]) for phase in self.PHASES]
+        images = [self.overlay_font.render(line, True, WHITE) for line in lines]
+        line_height = self.overlay_font.get_linesize()
+        image = pygame.Surface((max(line_image.get_width() for line_image in images) + 8,
+                                line_height*len(images) + 8))
+        image.fill(DARK_GRAY)
+        for i, line_image in enumerate(images):
+            image.blit(line_image, (4, 4 + i*line_height))
+        self.overlay = (self.n_frames, (image, (LEFT_BORDER + 4, TOP_BORDER + 4)))
+        return self.overlay[1]
+
+
+# ===== CONTROL PANEL =====
+class ControlPanel:
+    # All the controls of the applet: the slider bars, the buttons to change level, and the laser
+    # update() handles the controls and passes their settings to the simulation, without drawing anything, so the
+    # controls also work on an offscreen surface (e.g. when replaying a recorded session)
+
+    def __init__(self, surface, font):
+        self.slider_intensity = Slider(surface, (LEFT_BORDER + 192, WINDOW_HEIGHT-BOTTOM_BORDER + 32,
+                                                 WINDOW_WIDTH - RIGHT_BORDER - 192 - (LEFT_BORDER + 192), 12),
+                                       'horizontal', (0.5, 2.), None, (16, 24), 'Intensity', font, LIGHT_GRAY)
+        self.slider_hue = HueSlider(surface, (LEFT_BORDER + 192, WINDOW_HEIGHT-BOTTOM_BORDER + 96,
+                                              WINDOW_WIDTH - RIGHT_BORDER - 192 - (LEFT_BORDER + 192), 12),
+                                    'horizontal', (HUE_MIN, HUE_MAX), 141., (16, 24), 'Frequency', font, LIGHT_GRAY)
+        self.button_nextlevel = ImageButton(surface, (WINDOW_WIDTH - 80, WINDOW_HEIGHT-80, 64, 64),
+                                            'images/Next_idle.png', 'images/Next_hover.png')
+        self.button_prevlevel = ImageButton(surface, (16, WINDOW_HEIGHT-80, 64, 64),
+                                            'images/Prev_idle.png', 'images/Prev_hover.png')
+        self.laser = Laser(surface, (WINDOW_WIDTH - RIGHT_BORDER, TOP_BORDER, 64, PLAY_HEIGHT))
+        # In the gas mode, there is a second laser on the left, and a histogram of the velocities of the atoms
+        self.left_laser = Laser(surface, (LEFT_BORDER - 64, TOP_BORDER, 64, PLAY_HEIGHT), flipped=True)
+        self.histogram = VelocityHistogram(surface, (LEFT_BORDER, WINDOW_HEIGHT-BOTTOM_BORDER + 36, 176, 96), font)
+
+    def update(self, mouse_state, simulation):
+        # The 'update' function of a widget returns True if the button is clicked, or the value the slider is on
+        current_level = simulation.level
+        new_level = current_level
+        if current_level < N_LEVELS and self.button_nextlevel.update(mouse_state):
+            # "and" is short-circuited, so the button isn't used in the last level
+            new_level = min(current_level+1, N_LEVELS)
+        if current_level > 1 and self.button_prevlevel.update(mouse_state):
+            new_level = max(current_level-1, 1)
+        if current_level > 1:
+            color_hue = self.slider_hue.update(mouse_state)
+        else:
+            color_hue = 140
+        self.laser.update(mouse_state)
+        simulation.set_laser(self.laser.get_muzzle_xy(), color_hue, self.slider_intensity.update(mouse_state))
+
+        if new_level != current_level:
+            # Changing the level re-setups the room by clearing all particles, and resetting the atom timer
+            simulation.set_level(new_level)
+        if simulation.level == GAS_LEVEL:
+            self.histogram.update(simulation)
+
+    def visible_widgets(self, level):
+        # The controls that are shown in the given level
+        widgets = [self.slider_intensity, self.laser]
+        if level > 1:
+            widgets += [self.slider_hue, self.button_prevlevel]
+        if level < N_LEVELS:
+            widgets.append(self.button_nextlevel)
+        if level == GAS_LEVEL:
+            widgets += [self.left_laser, self.histogram]
+        return widgets
+
+
+# ===== INPUT RECORDING =====
+class InputRecorder:
+    # Writes the seed of the simulation and the mouse input of every frame to a compact binary log (7 bytes per
+    # frame, see INPUT_LOG_FRAME), so that the session can be replayed exactly with replay_input_log
+
+    def __init__(self, path, seed, buffer_size=65536):
+        self.file = open(path, 'wb')
+        self.file.write(INPUT_LOG_HEADER.pack(INPUT_LOG_MAGIC, INPUT_LOG_VERSION, seed))
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+
+    def record(self, mouse_state, n_steps):
+        (mouse_x, mouse_y), mouse_is_clicked, mouse_is_down = mouse_state
+        self.buffer += INPUT_LOG_FRAME.pack(mouse_x, mouse_y, mouse_is_clicked | mouse_is_down << 1, n_steps)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_input_log(path):
+    # Returns the seed and the list of (mouse_state, n_steps) of every frame in an input log
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    magic, version, seed = INPUT_LOG_HEADER.unpack_from(data)
+    if magic != INPUT_LOG_MAGIC or version != INPUT_LOG_VERSION:
+        raise ValueError('{} is not an input log of this version of the applet'.format(path))
+    frames = []
+    for mouse_x, mouse_y, buttons, n_steps in INPUT_LOG_FRAME.iter_unpack(data[INPUT_LOG_HEADER.size:]):
+        frames.append((((mouse_x, mouse_y), bool(buttons & 1), bool(buttons & 2)), n_steps))
+    return seed, frames
+
+
+def replay_input_log(path, trajectory_writer=None):
+    # Replay a recorded session headless and as fast as possible: the recorded mouse input is fed to the controls
+    # (on an offscreen surface), and the simulation does the same number of steps after every frame as during the
+    # recording, so it ends up in exactly the same state. Returns the simulation.
+    # If a TrajectoryWriter is given, the trajectories of the replayed session are saved with it
+    seed, frames = read_input_log(path)
+    pygame.font.init()
+    controls = ControlPanel(pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT)), ASSETS.get_font(FONT_SIZE_NORMAL))
+    simulation = Simulation(seed=seed)
+    simulation.physics_backend = HEADLESS_PHYSICS_BACKEND  # All backends give the same results
+    simulation.trajectory_writer = trajectory_writer
+    for mouse_state, n_steps in frames:
+        controls.update(mouse_state, simulation)
+        simulation.step(n_steps)
+    return simulation
+
+
+# ===== TRAJECTORY EXPORT =====
+class TrajectoryWriter:
+    # Streams the state of a simulation to disk, so that long (e.g. multi-hour, headless) runs can be analyzed with
+    # NumPy afterwards without running them again, see load_trajectory. There are three streams of records:
+    # - 'atoms': every 'every' frames, the frame, id, position, velocity and hue of all atoms (PARTICLE_RECORD_DTYPE)
+    # - 'photons': the same for the photons, only if include_photons is True
+    # - 'absorptions': every absorption, with the atom and the photon (ABSORPTION_RECORD_DTYPE)
+    # The records are collected in preallocated NumPy batches of batch_rows rows, never in Python lists. Full batches
+    # are handed to a background thread through a queue of at most queue_size batches, and the thread copies them
+    # into preallocated memory-mapped .npy files ('chunks') of chunk_rows rows. If the queue is full, write_frame
+    # waits for the thread if block is True; otherwise the batch is dropped and counted, so that the frame loop of
+    # the applet never waits for the disk. close() must be called at the end to write the last records.
+
+    def __init__(self, directory, every=1, include_photons=False, batch_rows=16384, chunk_rows=1048576,
+                 queue_size=8, block=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.every = every
+        self.include_photons = include_photons
+        self.batch_rows = batch_rows
+        self.chunk_rows = chunk_rows
+        self.block = block
+        self.dtypes = {'atoms': PARTICLE_RECORD_DTYPE, 'photons': PARTICLE_RECORD_DTYPE,
+                       'absorptions': ABSORPTION_RECORD_DTYPE}
+        # The batches are filled by the frame loop; of the form {stream: (records, number of rows in use)}
+        self.batches = {name: (np.zeros(batch_rows, dtype), 0) for name, dtype in self.dtypes.items()}
+        # The chunks are only used by the writer thread; of the form {stream: (memmap, number of rows in use)}
+        self.chunks = {name: (None, 0) for name in self.dtypes}
+        self.n_chunks = {name: 0 for name in self.dtypes}
+        self.n_rows = {name: 0 for name in self.dtypes}
+        self.n_frames = 0
+        self.n_dropped_batches = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # --- Called from the frame loop ---
+    def reserve(self, name, n_rows):
+        # Returns n_rows empty records at the end of the batch of the given stream, to be filled in
+        records, n_used = self.batches[name]
+        if n_used + n_rows > len(records):
+            self.flush(name)
+            records, n_used = np.zeros(max(self.batch_rows, n_rows), self.dtypes[name]), 0
+        self.batches[name] = (records, n_used + n_rows)
+        return records[n_used:n_used + n_rows]
+
+    def flush(self, name):
+        # Hand the batch of the given stream over to the writer thread, and start a new one
+        records, n_used = self.batches[name]
+        if n_used == 0:
+            return
+        self.batches[name] = (np.zeros(self.batch_rows, self.dtypes[name]), 0)
+        try:
+            self.queue.put((name, records[:n_used]), block=self.block)
+        except queue.Full:
+            self.n_dropped_batches += 1
+
+    def write_particles(self, name, pool, frame):
+        slots = pool.slots()
+        records = self.reserve(name, len(slots))
+        records['frame'] = frame
+        records['id'] = pool.ids[slots]
+        records['x'] = pool.positions[slots, 0]
+        records['y'] = pool.positions[slots, 1]
+        records['vx'] = pool.velocities[slots, 0]
+        records['vy'] = pool.velocities[slots, 1]
+        records['hue'] = pool.hues[slots]
+
+    def write_frame(self, simulation):
+        # Save the state of the particles after a step of the simulation
+        if simulation.frame % self.every == 0:
+            self.write_particles('atoms', simulation.atoms, simulation.frame)
+            if self.include_photons:
+                self.write_particles('photons', simulation.photons, simulation.frame)
+        self.n_frames += 1
+
+    def write_absorptions(self, simulation, absorbing_atoms, absorbed_photons):
+        # Save the absorptions of a step, as returned by collide_atoms
+        atoms = simulation.atoms
+        photons = simulation.photons
+        records = self.reserve('absorptions', len(absorbing_atoms))
+        # The step is not finished yet: simulation.frame is only increased at the end of the step, right before the
+        # particles are saved with write_frame, so the absorptions get the frame of those particle records
+        records['frame'] = simulation.frame + 1
+        records['atom_id'] = atoms.ids[absorbing_atoms]
+        records['photon_id'] = photons.ids[absorbed_photons]
+        records['photon_hue'] = photons.hues[absorbed_photons]
+        # The velocities of absorbed photons are already set to 0, but they did move in the last step
+        records['photon_vx'] = np.sign(photons.positions[absorbed_photons, 0] -
+                                       photons.previous_positions[absorbed_photons, 0])*SPEED_OF_LIGHT
+        records['x'] = atoms.positions[absorbing_atoms, 0]
+        records['y'] = atoms.positions[absorbing_atoms, 1]
+        records['vx'] = atoms.velocities[absorbing_atoms, 0]
+        records['vy'] = atoms.velocities[absorbing_atoms, 1]
+
+    def close(self):
+        # Write all remaining records, wait for the writer thread, and cut the last chunks to their real length
+        for name in self.dtypes:
+            self.flush(name)
+        self.queue.put(None)
+        self.thread.join()
+        for name in self.dtypes:
+            self.finish_chunk(name)
+        with open(os.path.join(self.directory, 'trajectory.json'), 'w') as info_file:
+            json.dump({'every': self.every, 'frames': self.n_frames, 'dropped_batches': self.n_dropped_batches,
+                       'rows': self.n_rows, 'chunks': self.n_chunks}, info_file, indent=1)
+        if self.error is not None:
+            raise self.error
+
+    # --- Called from the writer thread ---
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.store(*item)
+                except Exception as error:  # Reported by close(); the queue keeps being emptied until then
+                    self.error = error
+
+    def get_chunk_path(self, name, number):
+        return os.path.join(self.directory, '{}_{:05d}.npy'.format(name, number))
+
+    def store(self, name, records):
+        # Copy the records into the memory-mapped chunks of the stream, and start new chunks when they are full
+        while len(records) > 0:
+            chunk, n_used = self.chunks[name]
+            if chunk is None or n_used == len(chunk):
+                self.finish_chunk(name)
+                chunk = np.lib.format.open_memmap(self.get_chunk_path(name, self.n_chunks[name]), mode='w+',
+                                                  dtype=self.dtypes[name], shape=(self.chunk_rows,))
+                n_used = 0
+                self.n_chunks[name] += 1
+            n_stored = min(len(records), len(chunk) - n_used)
+            chunk[n_used:n_used + n_stored] = records[:n_stored]
+            self.chunks[name] = (chunk, n_used + n_stored)
+            self.n_rows[name] += n_stored
+            records = records[n_stored:]
+
+    def finish_chunk(self, name):
+        # Write the current chunk of the stream to disk; if it is not full, replace it by a file of the right length
+        chunk, n_used = self.chunks[name]
+        if chunk is None:
+            return
+        self.chunks[name] = (None, 0)
+        chunk.flush()
+        if n_used < len(chunk):
+            path = self.get_chunk_path(name, self.n_chunks[name] - 1)
+            np.save(path + '.part.npy', chunk[:n_used])
+            del chunk  # Close the memory map before the file is replaced
+            os.replace(path + '.part.npy', path)
+
+
+def load_trajectory(directory, name='atoms'):
+    # Load one stream ('atoms', 'photons' or 'absorptions') written by a TrajectoryWriter, as a list of structured
+    # arrays, one per chunk in order. The chunks are memory-mapped and are never copied as a whole, so only the parts
+    # that are used are read from disk, also for runs that are larger than the memory. Select from every chunk, e.g.
+    # np.concatenate([chunk[chunk['id'] == 12] for chunk in chunks]) for the trajectory of one atom.
+    # Only finished chunks are loaded: the .part.npy files that are being written at the moment are skipped.
+    numbered_paths = []
+    for path in glob.glob(os.path.join(directory, '{}_*.npy'.format(name))):
+        number = os.path.basename(path)[len(name) + 1:-len('.npy')]
+        if number.isdigit():
+            numbered_paths.append((int(number), path))
+    return [np.load(path, mmap_mode='r') for _, path in sorted(numbered_paths)]
 
 
 # ===== BUTTONS AND SLIDERS ===== #
@@ -418,17 +2118,35 @@ class Button:  # Bare-bones button, we are likely not going to make any of these
             mouse_inside = False
         return mouse_inside
 
+    def get_image(self, mouse_state):
+        image = pygame.Surface((self.width, self.height))
+        image.fill(BLACK)
+        return image
+
+    def get_sprite(self, mouse_state):
+        # Returns the image of the button and the position where it should be drawn
+        return self.get_image(mouse_state), (self.x, self.y)
+
+    def draw_track(self, surface=None):
+        # Buttons do not have a part that never changes
+        pass
+
     def draw(self, mouse_state):
-        pygame.draw.rect(self.surface, BLACK, self.bounding_rectangle)
+        image, xy = self.get_sprite(mouse_state)
+        self.surface.blit(image, xy)
 
-    def control(self, mouse_state):
-        # This function can be called in the main game loop to handle the entire button
-        self.draw(mouse_state)
+    def update(self, mouse_state):
+        # Handle the button without drawing it
         if self.is_active(mouse_state):
             return self.action()
         else:
             return self.idle()
 
+    def control(self, mouse_state):
+        # This function can be called in the main game loop to handle the entire button
+        self.draw(mouse_state)
+        return self.update(mouse_state)
+
 
 class ImageButton(Button):
     # This is a button with an image. There are three images: one for the idle state, one when the mouse hovers over,
@@ -445,11 +2163,11 @@ class ImageButton(Button):
         self.idle_image_path = idle_image_path
         self.hover_image_path = hover_image_path
         self.down_image_path = down_image_path
-        self.idle_image = pygame.transform.scale(pygame.image.load(idle_image_path), (self.width, self.height))
-        self.hover_image = pygame.transform.scale(pygame.image.load(hover_image_path), (self.width, self.height))
-        self.down_image = pygame.transform.scale(pygame.image.load(down_image_path), (self.width, self.height))
+        self.idle_image = ASSETS.get_image(idle_image_path, (self.width, self.height))
+        self.hover_image = ASSETS.get_image(hover_image_path, (self.width, self.height))
+        self.down_image = ASSETS.get_image(down_image_path, (self.width, self.height))
 
-    def draw(self, mouse_state):
+    def get_image(self, mouse_state):
         mouse_xy = mouse_state[0]
         mouse_is_clicked = mouse_state[1]
         if self.check_mouse(mouse_xy):
@@ -459,8 +2177,7 @@ class ImageButton(Button):
                 image = self.hover_image
         else:
             image = self.idle_image
-
-        self.surface.blit(image, (self.x, self.y))
+        return image
 
 
 class Slider:  # A slider bar
@@ -488,10 +2205,15 @@ class Slider:  # A slider bar
         self.sliding = False
         self.text_string = text_string
         if text_font is None:
-            self.text_font = pygame.font.SysFont('arial', 11)
+            self.text_font = ASSETS.get_font(FONT_SIZE_SMALL)
         else:
             self.text_font = text_font
         self.text_color = text_color
+        # The text is centered below the bar
+        text_size = self.text_font.size(self.text_string)
+        self.text_xy = (self.x + (self.width - text_size[0]) / 2,
+                        self.y + self.height/2 + self.slider_half_height)
+        self.knob_image = None
 
     def get_slider_activation(self, slider_xy):
         if self.direction == 'vertical':
@@ -540,34 +2262,52 @@ class Slider:  # A slider bar
             self.sliding = False
         return self.sliding
 
+    def draw_track(self, surface=None):
+        # Draw the parts of the slider that never change: the bar and the text
+        if surface is None:
+            surface = self.surface
+        pygame.draw.rect(surface, WHITE, self.bounding_rectangle)
+        pygame.draw.rect(surface, BLACK, self.bounding_rectangle, 1)
+        self.draw_text(surface)
+
+    def draw_text(self, surface):
+        surface.blit(TEXT_CACHE.render(self.text_font, self.text_string, self.text_color), self.text_xy)
+
+    def get_knob_image(self):
+        # The image of the part of the slider that moves, which is only drawn once
+        if self.knob_image is None:
+            knob_size = (int(2*self.slider_half_width), int(2*self.slider_half_height))
+            self.knob_image = pygame.Surface(knob_size, pygame.SRCALPHA)
+            if self.slider_half_width == self.slider_half_height:
+                pygame.draw.circle(self.knob_image, GRAY, (knob_size[0]/2, knob_size[1]/2), self.slider_half_width)
+                pygame.draw.circle(self.knob_image, BLACK, (knob_size[0]/2, knob_size[1]/2),
+                                   self.slider_half_height, 1)
+            else:
+                pygame.draw.rect(self.knob_image, GRAY, (0, 0) + knob_size)
+                pygame.draw.rect(self.knob_image, BLACK, (0, 0) + knob_size, 1)
+        return self.knob_image
+
+    def get_sprite(self, mouse_state=None):
+        # Returns the image of the knob and the position where it should be drawn
+        x, y = self.get_slider_xy()
+        return self.get_knob_image(), (int(x - self.slider_half_width), int(y - self.slider_half_height))
+
     def draw(self):
-        pygame.draw.rect(self.surface, WHITE, self.bounding_rectangle)
-        pygame.draw.rect(self.surface, BLACK, self.bounding_rectangle, 1)
-        if self.slider_half_width == self.slider_half_height:
-            pygame.draw.circle(self.surface, GRAY, self.get_slider_xy(), self.slider_half_width)
-            pygame.draw.circle(self.surface, BLACK, self.get_slider_xy(), self.slider_half_height, 1)
-        else:
-            x, y = self.get_slider_xy()
-            slider_rect = (x - self.slider_half_width, y - self.slider_half_height,
-                           2*self.slider_half_width, 2*self.slider_half_height)
-            pygame.draw.rect(self.surface, GRAY, slider_rect)
-            pygame.draw.rect(self.surface, BLACK, slider_rect, 1)
-
-        # Draw the text
-        text_surf = self.text_font.render(self.text_string, True, self.text_color)
-        text_size = self.text_font.size(self.text_string)
-        text_xy = (self.x + (self.width - text_size[0]) / 2,
-                   self.y + self.height/2 + self.slider_half_height)
-        self.surface.blit(text_surf, text_xy)
+        self.draw_track()
+        image, xy = self.get_sprite()
+        self.surface.blit(image, xy)
+
+    def update(self, mouse_state):
+        # Handle the slider without drawing it, and return the value it is currently on
+        # mouse_state is a tuple of the form (mouse_xy, mouse_is_clicked, mouse_is_down)
+        if self.is_sliding(mouse_state):
+            self.activation = self.get_slider_activation(mouse_state[0])
+        return self.get_slider_value()
 
     def control(self, mouse_state):
         # This function can be called in the main game loop to handle the entire slider
-        # mouse_state is a tuple of the form (mouse_xy, mouse_is_down)
-        mouse_xy = mouse_state[0]
         self.draw()
-        if self.is_sliding(mouse_state):
-            self.activation = self.get_slider_activation(mouse_xy)
-        return self.get_slider_value()
+        return self.update(mouse_state)
 
 
 class HueSlider(Slider):  # Exactly the same slider bar, but the background is colored
@@ -576,61 +2316,139 @@ class HueSlider(Slider):  # Exactly the same slider bar, but the background is c
         super().__init__(*args)
         min_hue = max(int(self.min_value), 0)
         max_hue = min(int(self.max_value), 360)
+        # One column of pixels per degree of hue, written in one go, and then stretched to the width of the slider
+        rainbow_colors = COLOR_TABLE.lookup(np.arange(min_hue, max_hue), 75, 75)
         rainbow_surface = pygame.Surface((max_hue-min_hue, self.height))
-        for hue in range(min_hue, max_hue + 1):
-            pygame.draw.line(rainbow_surface, hsv_to_rgb_norm((hue, 75, 75)),
-                             (hue-min_hue, 0), (hue-min_hue, self.height))
+        pygame.surfarray.blit_array(rainbow_surface, np.repeat(rainbow_colors[:, np.newaxis, :], self.height, axis=1))
         self.rainbow_surface = pygame.transform.scale(rainbow_surface, (self.width, self.height))
 
-    def draw(self):
-        self.surface.blit(self.rainbow_surface, (self.x, self.y))
-        pygame.draw.rect(self.surface, BLACK, self.bounding_rectangle, 1)
-        if self.slider_half_width == self.slider_half_height:
-            pygame.draw.circle(self.surface, GRAY, self.get_slider_xy(), self.slider_half_width)
-            pygame.draw.circle(self.surface, BLACK, self.get_slider_xy(), self.slider_half_height, 1)
-        else:
-            x, y = self.get_slider_xy()
-            slider_rect = (x - self.slider_half_width, y - self.slider_half_height,
-                           2 * self.slider_half_width, 2 * self.slider_half_height)
-            pygame.draw.rect(self.surface, GRAY, slider_rect)
-            pygame.draw.rect(self.surface, BLACK, slider_rect, 1)
-
-        # Draw the text
-        text_surf = self.text_font.render(self.text_string, True, self.text_color)
-        text_size = self.text_font.size(self.text_string)
-        text_xy = (self.x + (self.width - text_size[0]) / 2,
-                   self.y + self.height / 2 + self.slider_half_height)
-        self.surface.blit(text_surf, text_xy)
+    def draw_track(self, surface=None):
+        if surface is None:
+            surface = self.surface
+        surface.blit(self.rainbow_surface, (self.x, self.y))
+        pygame.draw.rect(surface, BLACK, self.bounding_rectangle, 1)
+        self.draw_text(surface)
 
 
 class Laser(Slider):  # The laser is technically a slider
 
-    def __init__(self, surface, bounding_rectangle, firing_delay=30, image_path='images/Laser.png'):
+    def __init__(self, surface, bounding_rectangle, image_path='images/Laser.png', flipped=False):
+        # A flipped laser points to the right instead of to the left
         x, y, width, height = bounding_rectangle
-        temp_image = pygame.image.load(image_path)
+        temp_image = ASSETS.get_image(image_path)
         image_width = width
         image_height = int(temp_image.get_height()*image_width/temp_image.get_width())  # Uniformly scale image
-        self.image = pygame.transform.scale(temp_image, (image_width, image_height))
+        self.image = ASSETS.get_image(image_path, (image_width, image_height), flipped)
+        self.flipped = flipped
         new_bounding_rectangle = (x, y + image_height/2, width, height - image_height)  # Cut off top and bottom
         super().__init__(surface, new_bounding_rectangle, 'vertical', (0., 1.), None, (image_width, image_height))
-        self.firing_delay = int(firing_delay)
-        self.timer = 0
 
-    def set_fire_rate(self, fire_rate):
-        self.firing_delay = int(FPS/fire_rate)
+    def get_muzzle_xy(self):
+        # The photons leave the laser on its left side (right side if flipped), at the height of the slider
+        if self.flipped:
+            return self.get_slider_xy()[0] + self.slider_half_width, self.get_slider_xy()[1]
+        return self.get_slider_xy()[0] - self.slider_half_width, self.get_slider_xy()[1]
+
+    def draw_track(self, surface=None):
+        # The laser has no visible bar
+        pass
+
+    def get_knob_image(self):
+        return self.image
 
-    def draw(self):
-        self.surface.blit(self.image, (self.get_slider_xy()[0] - self.slider_half_width,
-                                       self.get_slider_xy()[1] - self.slider_half_height))
 
-    def control_shoot(self, mouse_state, photon_hue, photons):
-        self.timer = (self.timer + 1) % self.firing_delay
-        if self.timer == 0:
-            photon_xy = (self.get_slider_xy()[0] - self.slider_half_width, self.get_slider_xy()[1])
-            new_photon = Photon(np.array(photon_xy), np.array((-SPEED_OF_LIGHT, 0)), (photon_hue, 100, 100))
-            photons.append(new_photon)
-        super().control(mouse_state)
+class VelocityHistogram:  # A live histogram of the x-velocities of the atoms, with their temperature
+    # Like the buttons and sliders, update() handles the logic and get_sprite() returns the image to draw, but the
+    # histogram only shows the state of the simulation. The image is only drawn again every 'interval' frames.
+
+    def __init__(self, surface, bounding_rectangle, text_font, bins=VELOCITY_HISTOGRAM_BINS, interval=5):
+        self.surface = surface
+        self.bounding_rectangle = bounding_rectangle
+        self.x = bounding_rectangle[0]
+        self.y = bounding_rectangle[1]
+        self.width = bounding_rectangle[2]
+        self.height = bounding_rectangle[3]
+        self.text_font = text_font
+        self.bins = bins
+        self.interval = interval
+        self.counts = np.zeros(len(bins) - 1, dtype=int)
+        self.temperature = (0., 0.)
+        self.n_updates = 0
+        self.image = None
+
+    def update(self, simulation):
+        if self.n_updates % self.interval == 0:
+            slots = simulation.atoms.slots()
+            self.counts = np.histogram(simulation.atoms.velocities[slots, 0], self.bins)[0]
+            self.temperature = simulation.temperature()
+            self.image = None
+        self.n_updates += 1
+
+    def get_image(self):
+        if self.image is None:
+            self.image = pygame.Surface((self.width, self.height))
+            self.image.fill(DARK_GRAY)
+            text = self.text_font.render('T = {:.0f} K'.format(self.temperature[0]), True, LIGHT_GRAY)
+            self.image.blit(text, (0, 0))
+            # The bars, scaled to the highest one, with a line at velocity 0
+            top = text.get_height() + 2
+            bar_width = self.width/len(self.counts)
+            bar_heights = (self.height - top)*self.counts/max(np.max(self.counts), 1)
+            for i, bar_height in enumerate(bar_heights.tolist()):
+                pygame.draw.rect(self.image, LIGHT_GRAY, (int(i*bar_width), int(self.height - bar_height),
+                                                          max(int(bar_width) - 1, 1), int(bar_height)))
+            zero_x = int(self.width*(0 - self.bins[0])/(self.bins[-1] - self.bins[0]))
+            pygame.draw.line(self.image, GRAY, (zero_x, top), (zero_x, self.height))
+        return self.image
+
+    def get_sprite(self, mouse_state=None):
+        return self.get_image(), (self.x, self.y)
+
+    def draw_track(self, surface=None):
+        # The histogram has no part that never changes
+        pass
+
+    def draw(self):
+        image, xy = self.get_sprite()
+        self.surface.blit(image, xy)
 
 
 if __name__ == '__main__':
-    main()
+    # python LaserCooling.py                           Run the applet
+    # python LaserCooling.py --record session.lcil     Run the applet and record the session
+    # python LaserCooling.py --profile timings.csv     Run the applet and save the frame timings when it is closed
+    #                                                  (as CSV, or as JSON if the file name ends in .json)
+    # python LaserCooling.py --trajectory run1         Run the applet and save the trajectories of the particles in the
+    #                                                  directory run1 (see TrajectoryWriter and load_trajectory)
+    # python LaserCooling.py --replay session.lcil     Replay a recorded session headless, and print the results
+    # python LaserCooling.py --startup-time start.json Start the applet, save how long every part of the startup
+    #                                                  took, and quit as soon as the first frame is on the screen
+    # The options --record, --profile and --trajectory can be combined, and --trajectory also works with --replay.
+    # Press F3 in the applet to show the frame timings.
+    parser = argparse.ArgumentParser(description='Laser cooling applet.')
+    parser.add_argument('--record', default=None, metavar='PATH', help='record the session to this file')
+    parser.add_argument('--replay', default=None, metavar='PATH',
+                        help='replay a recorded session headless, and print the results')
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help='save the frame timings to this file (CSV, or JSON if it ends in .json) when closed')
+    parser.add_argument('--trajectory', default=None, metavar='DIRECTORY',
+                        help='save the trajectories of the particles in this directory')
+    parser.add_argument('--startup-time', default=None, metavar='PATH',
+                        help='save how long every part of the startup took, and quit after the first frame')
+    arguments = parser.parse_args()
+    if arguments.replay is not None:
+        if arguments.record is not None or arguments.profile is not None or arguments.startup_time is not None:
+            parser.error('--replay can only be combined with --trajectory')
+        start_time = time.perf_counter()
+        writer = None
+        if arguments.trajectory is not None:
+            writer = TrajectoryWriter(arguments.trajectory)
+        replayed_simulation = replay_input_log(arguments.replay, writer)
+        if writer is not None:
+            writer.close()
+        replay_time = time.perf_counter() - start_time
+        print('Replayed {} physics steps ({:.1f} s of play) in {:.2f} s'.format(
+            replayed_simulation.frame, replayed_simulation.frame/FPS, replay_time))
+        print(replayed_simulation.metrics())
+    else:
+        main(arguments.record, arguments.profile, arguments.trajectory, arguments.startup_time)
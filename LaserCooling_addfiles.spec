@@ -2,7 +2,8 @@
 
 block_cipher = None
 
-added_files = [('images/*.png','images'), ('icon/Laser.ico','icon')]
+added_files = [('images/*.png','images'), ('icon/Laser.ico','icon'), ('fonts/DejaVuSans.ttf','fonts'),
+               ('fonts/LICENSE_DEJAVU','fonts')]
 
 
 a = Analysis(
@@ -0,0 +1,419 @@
+# Benchmarks for the laser cooling applet
+# By Matthew Houtput (matthew.houtput@uantwerpen.be)
+
+# Run this file with Python to time the hot paths of the simulation and the drawing, e.g.:
+#   python benchmark.py collisions
+#   python benchmark.py culling
+#   python benchmark.py backends
+#   python benchmark.py memory
+#   python benchmark.py startup
+#   python benchmark.py scenarios --output results.json
+#   python benchmark.py scenarios --baseline results.json
+# Without names, all benchmarks are run. The results can be saved as JSON with --output, and compared against the
+# results of an earlier run with --baseline. No display is needed: SDL's dummy video driver is used by default.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# pygame reads these environment variables when it is imported, so the imports below have to come after them
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np  # noqa: E402
+import pygame  # noqa: E402
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+import LaserCooling  # noqa: E402
+from LaserCooling import (AtomPool, PhotonPool, Simulation, Renderer, ControlPanel, FrameProfiler, collide_atoms,
+                          AbsorptionScheduler, PHYSICS_BACKENDS, ASSETS, FONT_SIZE_NORMAL, FONT_SIZE_LARGE,
+                          create_random_atom, draw_particles, ATOM_RADIUS, PHOTON_HIT_RADIUS, SPEED_OF_LIGHT,
+                          ATOM_COLLISION_SPEED_GAIN, LEFT_BORDER, TOP_BORDER, PLAY_WIDTH, PLAY_HEIGHT, WINDOW_WIDTH,
+                          WINDOW_HEIGHT, RIGHT_BORDER, FPS, GAS_LEVEL, GAS_ATOM_RADIUS)  # noqa: E402
+
+
+# ===== HELPER FUNCTIONS =====
+def time_frames(frame_function, n_frames):
+    # Call frame_function n_frames times, and return the duration of every call in seconds
+    frame_times = np.zeros(n_frames)
+    for i in range(n_frames):
+        start = time.perf_counter()
+        frame_function()
+        frame_times[i] = time.perf_counter() - start
+    return frame_times
+
+
+def percentiles(times):
+    # The median and the 99th percentile of a list of durations in seconds, in milliseconds
+    return {'p50_ms': 1000*float(np.percentile(times, 50)), 'p99_ms': 1000*float(np.percentile(times, 99))}
+
+
+def peak_rss_mb():
+    # The peak memory use (resident set size) of this process so far, or None if it cannot be measured
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss/1024**2  # In bytes on macOS
+    return peak_rss/1024  # In kilobytes on Linux
+
+
+def measure_gas_memory(n_atoms, dtype_name, n_frames=100):
+    # Fill the gas mode with n_atoms atoms stored as dtype_name, and run it for n_frames frames
+    # Returns the bytes of state per atom, the peak of the memory allocated by Python and NumPy (in MB, traced with
+    # tracemalloc, which is exact), and how much the peak memory use of the process grew (in MB), from right before
+    # the atoms were added until the end. The growth of the process depends on how the memory that was freed before
+    # is reused, so it varies from run to run; this should run in a fresh process, see benchmark_memory.
+    simulation = Simulation(seed=0)
+    simulation.set_level(GAS_LEVEL, 140.)
+    simulation.step()
+    simulation.atoms = AtomPool(1, GAS_ATOM_RADIUS, dtype_name)
+    simulation.atoms.clear()
+    rss_before = peak_rss_mb()
+    tracemalloc.start()
+    simulation.atoms = AtomPool(n_atoms, GAS_ATOM_RADIUS, dtype_name)
+    simulation.fill_gas(n_atoms)
+    simulation.step(n_frames)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    atoms = simulation.atoms
+    state_bytes = sum(getattr(atoms, name).nbytes for name in atoms.array_names() + ['dead'])/atoms.capacity
+    return {'state_bytes_per_atom': state_bytes, 'traced_peak_mb': traced_peak/1024**2,
+            'rss_growth_mb': peak_rss_mb() - rss_before}
+
+
+def collide_atoms_all_pairs(atoms, photons):
+    # Reference implementation of collide_atoms without the spatial index: every atom is checked against every
+    # photon. Only used to compare against.
+    if atoms.count == 0 or photons.count == 0:
+        return
+    atom_slots = atoms.slots()
+    photon_slots = photons.slots()
+    relative_positions = atoms.positions[atom_slots, np.newaxis, :] - photons.positions[np.newaxis, photon_slots]
+    hits = (np.sum(relative_positions**2, axis=2) < (ATOM_RADIUS + PHOTON_HIT_RADIUS)**2) & \
+           (np.abs(atoms.hues[atom_slots, np.newaxis] - photons.hues[np.newaxis, photon_slots]) <
+            atoms.hue_ranges[atom_slots, np.newaxis])
+    absorbed_photons = np.flatnonzero(np.any(hits, axis=0))
+    if len(absorbed_photons) == 0:
+        return
+    absorbing_atoms = atom_slots[np.argmax(hits[:, absorbed_photons], axis=0)]
+    absorbed_photons = photon_slots[absorbed_photons]
+    np.add.at(atoms.velocities, absorbing_atoms, (-ATOM_COLLISION_SPEED_GAIN, 0.))
+    photons.remove(absorbed_photons)
+
+
+def make_collision_scene(n_photons, n_atoms=20, n_frames=0, seed=0, absorbed_fraction=0.):
+    # A play area with n_atoms atoms, and n_photons photons in random rows that keep streaming through it for
+    # n_frames frames. Only a fraction absorbed_fraction of the photons have a hue the atoms absorb, so the number of
+    # photons stays roughly constant.
+    rng = np.random.default_rng(seed)
+    atoms = AtomPool(n_atoms)
+    photons = PhotonPool(n_photons)
+    for _ in range(n_atoms):
+        atoms.add((rng.uniform(LEFT_BORDER, LEFT_BORDER + PLAY_WIDTH),
+                   rng.uniform(TOP_BORDER, TOP_BORDER + PLAY_HEIGHT)), (1., 0.), (100, 100, 100), False, 25)
+    for _ in range(n_photons):
+        photons.add((rng.uniform(LEFT_BORDER, LEFT_BORDER + PLAY_WIDTH + n_frames*SPEED_OF_LIGHT),
+                     rng.uniform(TOP_BORDER, TOP_BORDER + PLAY_HEIGHT)), (-SPEED_OF_LIGHT, 0.),
+                    100 if rng.uniform() < absorbed_fraction else 250)
+    return atoms, photons
+
+
+def fill_play_area(simulation, n_atoms, rng):
+    # Add n_atoms atoms of the current level, spread over the whole play area
+    for _ in range(n_atoms):
+        create_random_atom(simulation.atoms, simulation.level, simulation.hsv_color, simulation.rng)
+    slots = simulation.atoms.slots()
+    simulation.atoms.positions[slots, 0] = rng.uniform(LEFT_BORDER, LEFT_BORDER + PLAY_WIDTH, len(slots))
+    simulation.atoms.previous_positions[slots] = simulation.atoms.positions[slots]
+    simulation.atoms.changed()
+
+
+def sweep_laser(simulation, frame, period=4*FPS):
+    # Move the laser up and down the rail, like a student trying to hit all atoms
+    phase = abs((frame % period)/period*2 - 1)
+    simulation.set_laser((WINDOW_WIDTH - RIGHT_BORDER, TOP_BORDER + ATOM_RADIUS + phase*(PLAY_HEIGHT - 2*ATOM_RADIUS)))
+
+
+# The scenarios of benchmark_scenarios, of the form {name: (level, laser_intensity, n_atoms_at_start,
+# sweep_the_laser, n_frames)}. The intensity is the number of photons per second; the sliders in the applet go from
+# 0.5 to 2, and an intensity of FPS fires a photon every step, which saturates the play area with photons.
+SCENARIOS = {'level 1, light load': (1, 1., 0, False, 900),
+             'level 2, light load': (2, 1., 0, False, 900),
+             'level 3, light load': (3, 1., 0, False, 900),
+             'level 2, saturated photon stream': (2, FPS, 20, True, 900),
+             'level 3, many atoms with Doppler recoloring': (3, FPS, 150, True, 900),
+             'level 2, long session': (2, 2., 0, True, 18000),
+             'level 4, gas mode': (4, 2., 0, False, 900)}
+
+
+# ===== BENCHMARKS =====
+def benchmark_collisions(photon_counts=(10, 100, 1000, 3000, 10000), n_frames=200, absorbed_fraction=0.01):
+    # Time one frame of collision detection (move + collide) for an increasing number of photons, with the
+    # spatial index, with the event queue of the AbsorptionScheduler, and checking all pairs. With the index and the
+    # event queue, the frame time should stay roughly flat. The event queue predicts the absorptions of all photons
+    # in its first frame, which is not counted.
+    print('Collision detection, 20 atoms, median time per frame:')
+    print('{:>10} {:>16} {:>16} {:>16}'.format('photons', 'row index (ms)', 'event queue (ms)', 'all pairs (ms)'))
+    results = {}
+    for n_photons in photon_counts:
+        frame_times = []
+        for method in ('row_index', 'event_queue', 'all_pairs'):
+            atoms, photons = make_collision_scene(n_photons, n_frames=n_frames + 1,
+                                                  absorbed_fraction=absorbed_fraction)
+            scheduler = AbsorptionScheduler()
+            frame_number = [0]
+
+            def frame():
+                photons.move()
+                atoms.move()
+                if method == 'row_index':
+                    collide_atoms(atoms, photons)
+                elif method == 'event_queue':
+                    scheduler.collide(atoms, photons, frame_number[0])
+                else:
+                    collide_atoms_all_pairs(atoms, photons)
+                photons.sweep()
+                frame_number[0] += 1
+            frame()
+            frame_times.append(time_frames(frame, n_frames))
+        results['{} photons'.format(n_photons)] = {method: percentiles(times) for method, times in
+                                                   zip(('row_index', 'event_queue', 'all_pairs'), frame_times)}
+        print('{:>10} {:>16.3f} {:>16.3f} {:>16.3f}'.format(n_photons,
+                                                            *(1000*np.median(times) for times in frame_times)))
+    return results
+
+
+def benchmark_scenarios(scenarios=SCENARIOS, seed=0):
+    # Run every scenario as in the applet: one physics step and one drawn frame per frame, on the dummy display.
+    # Besides the full frames, the hot paths are timed on their own every frame: the collisions (collide_atoms),
+    # recoloring the atoms for the Doppler effect (AtomPool.update_hues), drawing the particles (draw_particles),
+    # and drawing the text of a slider (Slider.draw_text).
+    pygame.init()
+    display_surf = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    font_normal = ASSETS.get_font(FONT_SIZE_NORMAL)
+    controls = ControlPanel(display_surf, font_normal)
+    offscreen_surf = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT))
+    mouse_state = ((0, 0), False, False)
+    results = {}
+    print('{:>44} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'frames/s', 'p50 (ms)', 'p99 (ms)', 'collide', 'recolor', 'particles', 'text', 'RSS (MB)'))
+    for name, (level, intensity, n_atoms, laser_sweeps, n_frames) in scenarios.items():
+        rng = np.random.default_rng(seed)
+        renderer = Renderer(display_surf, ASSETS.get_font(FONT_SIZE_LARGE), font_normal)
+        simulation = Simulation(level, seed=seed)
+        simulation.set_laser(intensity=intensity)
+        fill_play_area(simulation, n_atoms, rng)
+        simulation.profiler = FrameProfiler(n_frames)
+        widgets = controls.visible_widgets(level)
+        times = {key: np.zeros(n_frames) for key in ('full_frame', 'update_hues', 'draw_particles', 'draw_text')}
+        rss_start = None
+        for frame in range(n_frames):
+            if laser_sweeps:
+                sweep_laser(simulation, frame)
+            start = time.perf_counter()
+            simulation.step()
+            renderer.draw(simulation, level, widgets, mouse_state)
+            times['full_frame'][frame] = time.perf_counter() - start
+            simulation.profiler.end_frame()
+
+            start = time.perf_counter()
+            simulation.atoms.update_hues(simulation.atoms.slots())
+            times['update_hues'][frame] = time.perf_counter() - start
+            start = time.perf_counter()
+            draw_particles(offscreen_surf, simulation.atoms, simulation.photons)
+            times['draw_particles'][frame] = time.perf_counter() - start
+            start = time.perf_counter()
+            controls.slider_intensity.draw_text(offscreen_surf)
+            times['draw_text'][frame] = time.perf_counter() - start
+            if frame == n_frames//10:
+                rss_start = peak_rss_mb()
+
+        # The collisions are timed by the frame profiler of the simulation
+        timings, counts, first_frame = simulation.profiler.recent_timings()
+        collide_times = timings[:, FrameProfiler.PHASES.index('collide')]/1000
+        rss_end = peak_rss_mb()
+        result = {key: percentiles(value) for key, value in times.items()}
+        result['collide_atoms'] = percentiles(collide_times)
+        result.update({'frames': n_frames, 'frames_per_second': n_frames/np.sum(times['full_frame']),
+                       'peak_rss_mb': rss_end,
+                       'rss_growth_mb': None if rss_end is None else rss_end - rss_start,
+                       'pools': simulation.stats(), 'metrics': simulation.metrics()})
+        results[name] = result
+        print('{:>44} {:>10.0f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9}'.format(
+            name, result['frames_per_second'], result['full_frame']['p50_ms'], result['full_frame']['p99_ms'],
+            result['collide_atoms']['p99_ms'], result['update_hues']['p99_ms'], result['draw_particles']['p99_ms'],
+            result['draw_text']['p99_ms'], 'n/a' if rss_end is None else '{:.1f}'.format(rss_end)))
+    print('(collide, recolor, particles and text are p99 times in ms)')
+    return results
+
+
+def benchmark_culling(particle_counts=(1000, 10000, 100000, 1000000), n_frames=20, seed=0):
+    # Time the removal of particles under heavy absorption: every frame, a full pool loses half of its particles in
+    # three overlapping batches (as the absorbed photons, the photons that left the play area, and again photons
+    # that were already removed), which are then swept, and the pool is filled again. The time per particle should
+    # stay flat as the pool grows. That the right particles are removed is tested in test_pools.py.
+    print('Culling half of a full pool, median time per frame:')
+    print('{:>10} {:>12} {:>16}'.format('particles', 'time (ms)', 'per particle (ns)'))
+    rng = np.random.default_rng(seed)
+    results = {}
+    for n_particles in particle_counts:
+        pool = PhotonPool(n_particles)
+        positions = np.zeros((n_particles, 2))
+        pool.add_many(positions, positions, np.zeros(n_particles))
+        frame_times = np.zeros(n_frames)
+        for frame in range(n_frames):
+            removed = rng.random(n_particles) < 0.5
+            removed_slots = np.flatnonzero(removed)
+            batches = (removed_slots[::2], removed_slots[1::2], removed_slots[rng.random(len(removed_slots)) < 0.5])
+            start = time.perf_counter()
+            for batch in batches:
+                pool.mark_dead(batch)
+            pool.sweep()
+            frame_times[frame] = time.perf_counter() - start
+            pool.add_many(positions[:pool.n_free], positions[:pool.n_free], np.zeros(pool.n_free))
+        results['{} particles'.format(n_particles)] = percentiles(frame_times)
+        print('{:>10} {:>12.3f} {:>16.1f}'.format(n_particles, 1000*np.median(frame_times),
+                                                  1e9*np.median(frame_times)/n_particles))
+    return results
+
+
+def benchmark_backends(n_frames=300, n_frames_python=30, seed=0):
+    # Time the gas mode with every backend of collide_atoms (see PHYSICS_BACKENDS) from the same seed; that they all
+    # give the same atoms is tested in test_pools.py. The 'python' backend runs the loops of the Numba kernel without
+    # compiling them, so it is only run for n_frames_python frames; the 'numba' backend is only there if Numba is
+    # installed, and is run once before it is timed, so that it is compiled.
+    print('Gas mode with every physics backend, median time per step:')
+    print('{:>8} {:>8} {:>12} {:>10}'.format('backend', 'frames', 'time (ms)', 'absorbed'))
+
+    def run(backend, frames):
+        simulation = Simulation(seed=seed)
+        simulation.physics_backend = backend
+        simulation.set_level(GAS_LEVEL, 140.)
+        simulation.set_laser(hue=130., intensity=2.)
+        return time_frames(simulation.step, frames), simulation.metrics()
+
+    results = {}
+    for backend in PHYSICS_BACKENDS:
+        frames = n_frames_python if backend == 'python' else n_frames
+        if backend == 'numba':
+            run(backend, 1)
+        frame_times, metrics = run(backend, frames)
+        results[backend] = percentiles(frame_times)
+        print('{:>8} {:>8} {:>12.3f} {:>10}'.format(backend, frames, 1000*np.median(frame_times),
+                                                    metrics['photons_absorbed']))
+    return results
+
+
+def benchmark_memory(n_atoms=10000, dtypes=('float64', 'float32')):
+    # Measure the memory use of the gas mode with n_atoms atoms, stored in float64 (as all pools were before) and in
+    # float32 (as the gas mode is now, see GAS_ATOM_DTYPE). Every measurement runs in a new process, because the
+    # peak memory use of a process never goes down. Both peaks include the temporary arrays of the steps.
+    if resource is None:
+        print('The memory use cannot be measured on this platform')
+        return {}
+    print('Gas mode with {} atoms:'.format(n_atoms))
+    print('{:>8} {:>16} {:>16} {:>16} {:>16}'.format('dtype', 'state (B/atom)', 'traced peak (MB)', 'traced (B/atom)',
+                                                     'RSS growth (MB)'))
+    results = {}
+    for dtype_name in dtypes:
+        code = 'import json, benchmark; print(json.dumps(benchmark.measure_gas_memory({}, {!r})))'.format(
+            n_atoms, dtype_name)
+        output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[dtype_name] = json.loads(output.splitlines()[-1])
+        result = results[dtype_name]
+        print('{:>8} {:>16.0f} {:>16.2f} {:>16.0f} {:>16.2f}'.format(
+            dtype_name, result['state_bytes_per_atom'], result['traced_peak_mb'],
+            1024**2*result['traced_peak_mb']/n_atoms, result['rss_growth_mb']))
+    return results
+
+
+def benchmark_startup(n_runs=5, command=None):
+    # Start the applet n_runs times in a new process, with --startup-time, and time how long it takes until the
+    # first frame is on the screen. The time of the whole process includes starting Python and importing pygame
+    # and NumPy; the time of every part of main() is taken from the saved startup times.
+    # To time a PyInstaller build instead of the script, pass e.g. command=['dist/LaserCooling'].
+    if command is None:
+        command = [sys.executable, 'LaserCooling.py']
+    process_times = np.zeros(n_runs)
+    phase_times = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'startup.json')
+        for i in range(n_runs):
+            start = time.perf_counter()
+            subprocess.run(command + ['--startup-time', path], check=True, stdout=subprocess.DEVNULL)
+            process_times[i] = time.perf_counter() - start
+            with open(path) as startup_file:
+                startup = json.load(startup_file)
+            for phase, duration in startup['startup_ms'].items():
+                phase_times.setdefault(phase, []).append(duration)
+    results = {'process': percentiles(process_times), 'assets': startup['assets']}
+    results.update({phase: {'p50_ms': float(np.median(durations))} for phase, durations in phase_times.items()})
+    print('Startup, median of {} runs:'.format(n_runs))
+    print('{:>12} {:>10.1f} ms'.format('process', results['process']['p50_ms']))
+    for phase in phase_times:
+        print('{:>12} {:>10.1f} ms'.format(phase, results[phase]['p50_ms']))
+    return results
+
+
+BENCHMARKS = {'collisions': benchmark_collisions, 'culling': benchmark_culling, 'backends': benchmark_backends,
+              'memory': benchmark_memory, 'startup': benchmark_startup, 'scenarios': benchmark_scenarios}
+
+
+# ===== COMPARING RESULTS =====
+def flatten_results(results, prefix=''):
+    # The numbers in a nested dictionary of results, of the form {'key/subkey/...': number}
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten_results(value, prefix + key + '/'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare_results(results, baseline):
+    # Print the frame rates and frame times that changed compared to the baseline; a ratio above 1 means slower
+    new = flatten_results(results)
+    old = flatten_results(baseline)
+    print('Compared to the baseline (time ratio, above 1 is slower):')
+    for key in new:
+        if key not in old or old[key] == 0 or new[key] == 0:
+            continue
+        if key.endswith('_ms'):
+            ratio = new[key]/old[key]
+        elif key.endswith('frames_per_second'):
+            ratio = old[key]/new[key]
+        else:
+            continue
+        print('{:<80} {:9.3f} -> {:9.3f} ({:.2f}x)'.format(key, old[key], new[key], ratio))
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(LaserCooling.__file__)))
+    parser = argparse.ArgumentParser(description='Benchmark the laser cooling applet.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run: {} (default: all)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--output', default=None, help='save the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare the results to this JSON file')
+    arguments = parser.parse_args()
+    for benchmark_name in arguments.names:
+        if benchmark_name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(benchmark_name))
+    all_results = {}
+    for benchmark_name in arguments.names or list(BENCHMARKS):
+        all_results[benchmark_name] = BENCHMARKS[benchmark_name]()
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(all_results, output_file, indent=1)
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            compare_results(all_results, json.load(baseline_file))
@@ -0,0 +1,206 @@
+# Offline renderer for the laser cooling applet
+# By Matthew Houtput (matthew.houtput@uantwerpen.be)
+
+# Renders a recorded session, or a scripted demo of one level, to a sequence of PNG files or to raw video, without
+# opening a window and faster than real time. This is e.g. useful to make recordings for lectures:
+#   python render.py --replay session.lcil --output frames
+#   python render.py --level 3 --seconds 60 --hue 120 --sweep 8 --output level3
+#   python render.py --level 4 --seconds 60 --raw - | ffmpeg -f rawvideo -pix_fmt rgb24 -s 800x464 -r 30 -i - gas.mp4
+# Every physics step becomes one frame of the video, so the video plays at FPS frames per second.
+# The simulation and the drawing run in this process, one frame after the other. The frames are handed to a pool of
+# worker processes that compress and save them (for PNG files), or to a thread that writes them (for raw video), so
+# that the drawing never waits for the disk. The raw video is RGB24: 3 bytes per pixel, row by row, no header.
+
+import argparse
+import collections
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+# pygame reads these environment variables when it is imported, so the imports below have to come after them
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np  # noqa: E402
+import pygame  # noqa: E402
+
+import LaserCooling  # noqa: E402
+from LaserCooling import (Simulation, ControlPanel, Renderer, ASSETS, read_input_log, FONT_SIZE_NORMAL,
+                          FONT_SIZE_LARGE, WINDOW_WIDTH, WINDOW_HEIGHT, FPS, N_LEVELS, HUE_MIN, HUE_MAX,
+                          HEADLESS_PHYSICS_BACKEND)  # noqa: E402
+
+
+# ===== FRAME OUTPUT =====
+def encode_png(data, size, compression=3):
+    # Encode one frame, given as RGB24 bytes, as a PNG file with the given zlib compression level (0-9)
+    # The applet has large areas of one color, so the rows are not filtered; at a low compression level, this is
+    # several times faster than pygame.image.save, and the files are only a little larger
+    width, height = size
+    rows = np.frombuffer(data, dtype=np.uint8).reshape(height, 3*width)
+    filtered_rows = np.concatenate((np.zeros((height, 1), dtype=np.uint8), rows), axis=1)  # Filter type 0: none
+
+    def chunk(chunk_type, chunk_data):
+        return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + \
+            struct.pack('>I', zlib.crc32(chunk_type + chunk_data))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)  # 8 bits per channel, RGB
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + \
+        chunk(b'IDAT', zlib.compress(filtered_rows.tobytes(), compression)) + chunk(b'IEND', b'')
+
+
+def save_png(path, data, size, compression=3):
+    # Save one frame as a PNG file; this runs in a worker process
+    with open(path, 'wb') as png_file:
+        png_file.write(encode_png(data, size, compression))
+
+
+class PngSequenceWriter:
+    # Saves the frames as frame_000000.png, frame_000001.png, ... in a directory, compressed by a pool of worker
+    # processes. At most max_pending frames are waiting for a worker at the same time, so that a slow disk cannot
+    # fill up the memory; if there are more, write() waits for the oldest one.
+
+    def __init__(self, directory, size, max_workers=None, max_pending=None, compression=3):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.size = size
+        self.compression = compression
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending or 4*(max_workers or os.cpu_count() or 1)
+        self.pending = collections.deque()
+        self.n_frames = 0
+
+    def write(self, data):
+        path = os.path.join(self.directory, 'frame_{:06d}.png'.format(self.n_frames))
+        self.pending.append(self.executor.submit(save_png, path, data, self.size, self.compression))
+        self.n_frames += 1
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+
+class RawVideoWriter:
+    # Writes the frames one after the other to a file (or to stdout if the path is '-'), on a background thread
+    # The queue holds at most max_pending frames; if the disk cannot keep up, write() waits
+
+    def __init__(self, path, max_pending=64):
+        if path == '-':
+            self.file = sys.stdout.buffer
+            self.close_file = False
+        else:
+            self.file = open(path, 'wb')
+            self.close_file = True
+        self.queue = queue.Queue(max_pending)
+        self.n_frames = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        self.queue.put(data)
+        self.n_frames += 1
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            self.file.write(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.flush()
+        if self.close_file:
+            self.file.close()
+
+
+# ===== RENDERING =====
+def scripted_frames(n_frames, controls, sweep_period=None):
+    # The input of a scripted demo: the mouse is never used, and there is one physics step per frame
+    # If sweep_period is given (in seconds), the laser moves up and down its rail once in every period
+    mouse_state = ((0, 0), False, False)
+    for frame in range(n_frames):
+        if sweep_period is not None:
+            phase = (frame % (sweep_period*FPS))/(sweep_period*FPS)
+            controls.laser.set_slider_value(1 - abs(2*phase - 1))
+        yield mouse_state, 1
+
+
+def render(simulation, controls, renderer, frames, writer):
+    # Feed the input of every frame (a (mouse_state, n_steps) pair, as in an input log) to the controls, and write
+    # one frame of video after every physics step
+    surface = renderer.surface
+    for mouse_state, n_steps in frames:
+        controls.update(mouse_state, simulation)
+        for _ in range(n_steps):
+            simulation.step()
+            renderer.draw(simulation, simulation.level, controls.visible_widgets(simulation.level), mouse_state)
+            writer.write(pygame.image.tobytes(surface, 'RGB'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the laser cooling applet offline, to PNG files or raw video.')
+    parser.add_argument('--replay', default=None, help='render this recorded session (see LaserCooling.py --record)')
+    parser.add_argument('--level', type=int, default=1, help='level of a scripted demo (1-{})'.format(N_LEVELS))
+    parser.add_argument('--seconds', type=float, default=60., help='length of a scripted demo, in seconds')
+    parser.add_argument('--hue', type=float, default=None, help='laser hue of a scripted demo')
+    parser.add_argument('--intensity', type=float, default=None, help='laser intensity of a scripted demo (0.5-2)')
+    parser.add_argument('--atom-hue', type=float, default=None, help='hue of the atoms in levels 3 and 4')
+    parser.add_argument('--sweep', type=float, default=None,
+                        help='move the laser up and down once every this many seconds in a scripted demo')
+    parser.add_argument('--seed', type=int, default=None, help='seed of a scripted demo')
+    parser.add_argument('--output', default=None, help='save the frames as PNG files in this directory')
+    parser.add_argument('--raw', default=None, help="write the frames as raw RGB24 video to this file ('-': stdout)")
+    parser.add_argument('--compression', type=int, default=3, choices=range(10),
+                        help='zlib compression level of the PNG files, from 0 (fastest) to 9 (smallest)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    arguments = parser.parse_args()
+    if (arguments.output is None) == (arguments.raw is None):
+        parser.error('give either --output or --raw')
+    if not 1 <= arguments.level <= N_LEVELS:
+        parser.error('the level should be between 1 and {}'.format(N_LEVELS))
+
+    size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+    if arguments.output is not None:
+        writer = PngSequenceWriter(arguments.output, size, arguments.workers, compression=arguments.compression)
+    else:
+        writer = RawVideoWriter(arguments.raw)
+
+    pygame.init()
+    display_surf = pygame.display.set_mode(size)
+    font_normal = ASSETS.get_font(FONT_SIZE_NORMAL)
+    controls = ControlPanel(display_surf, font_normal)
+    renderer = Renderer(display_surf, ASSETS.get_font(FONT_SIZE_LARGE), font_normal)
+    if arguments.replay is not None:
+        seed, frames = read_input_log(arguments.replay)
+        simulation = Simulation(seed=seed)
+    else:
+        simulation = Simulation(seed=arguments.seed)
+        simulation.set_level(arguments.level, arguments.atom_hue)
+        if arguments.hue is not None:
+            controls.slider_hue.set_slider_value(min(max(arguments.hue, HUE_MIN), HUE_MAX))
+        if arguments.intensity is not None:
+            controls.slider_intensity.set_slider_value(arguments.intensity)
+        frames = scripted_frames(int(arguments.seconds*FPS), controls, arguments.sweep)
+    simulation.physics_backend = HEADLESS_PHYSICS_BACKEND
+
+    start_time = time.perf_counter()
+    render(simulation, controls, renderer, frames, writer)
+    writer.close()
+    render_time = time.perf_counter() - start_time
+    # The summary goes to stderr, because the video itself may go to stdout
+    print('Rendered {} frames ({:.1f} s of video) in {:.1f} s, {:.1f}x real time'.format(
+        writer.n_frames, writer.n_frames/FPS, render_time, writer.n_frames/FPS/render_time), file=sys.stderr)
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(LaserCooling.__file__)))
+    main()
@@ -0,0 +1,114 @@
+# Parameter sweeps for the laser cooling applet
+# By Matthew Houtput (matthew.houtput@uantwerpen.be)
+
+# Runs many headless simulations over a grid of laser settings, spread over all CPU cores, and collects what happened
+# to the atoms in each of them. This is e.g. useful to make a Doppler cooling detuning curve:
+#   python sweep.py --levels 3 --atom-hue 160 --hues 100:220:25 --frames 18000 --output detuning.json
+# Lists of values are given as 'a,b,c' or as 'start:stop:number' (evenly spaced, including the end points).
+# Every simulation gets its own seed, derived from --seed and its place in the grid, so the results are the same
+# for any number of worker processes.
+
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# pygame reads these environment variables when it is imported, so the imports below have to come after them
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np  # noqa: E402
+
+import LaserCooling  # noqa: E402
+from LaserCooling import (Simulation, PHYSICS_BACKENDS, HEADLESS_PHYSICS_BACKEND, HUE_MIN, HUE_MAX, TOP_BORDER,
+                          PLAY_HEIGHT, WINDOW_WIDTH, RIGHT_BORDER)  # noqa: E402
+
+
+# ===== RUNNING SIMULATIONS =====
+def run_simulation(parameters):
+    # Run one headless simulation with the given parameters (a dictionary, see make_grid) and return its metrics
+    # The laser position is the height of the laser, as a fraction of the play area (0 is the top, 1 the bottom)
+    simulation = Simulation(seed=parameters['seed'])
+    simulation.physics_backend = parameters['backend']
+    simulation.set_level(parameters['level'], parameters['atom_hue'])
+    simulation.set_laser((WINDOW_WIDTH - RIGHT_BORDER, TOP_BORDER + parameters['position']*PLAY_HEIGHT),
+                         parameters['hue'], parameters['intensity'])
+    simulation.step(parameters['frames'])
+    return {'parameters': parameters, 'metrics': simulation.metrics()}
+
+
+def make_grid(levels, hues, intensities, positions, n_frames, atom_hue=None, seed=0,
+              backend=HEADLESS_PHYSICS_BACKEND):
+    # All combinations of the given parameter values, as a list of dictionaries
+    # The seed of every simulation only depends on the base seed and the index of the simulation in the grid
+    grid = []
+    combinations = itertools.product(levels, hues, intensities, positions)
+    for index, (level, hue, intensity, position) in enumerate(combinations):
+        simulation_seed = int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+        grid.append({'level': level, 'hue': hue, 'intensity': intensity, 'position': position, 'atom_hue': atom_hue,
+                     'frames': n_frames, 'seed': simulation_seed, 'backend': backend})
+    return grid
+
+
+def run_sweep(grid, max_workers=None):
+    # Run all simulations in the grid in a pool of worker processes; the results are in the same order as the grid
+    # The grid is handed out in chunks, so that short simulations do not spend most of their time waiting on the pool
+    chunk_size = max(1, len(grid)//(4*(max_workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_simulation, grid, chunksize=chunk_size))
+
+
+# ===== COMMAND LINE =====
+def parse_values(string, value_type=float):
+    # Parse 'a,b,c' into [a, b, c] and 'start:stop:number' into evenly spaced values
+    if ':' in string:
+        start, stop, number = string.split(':')
+        return [value_type(value) for value in np.linspace(float(start), float(stop), int(number))]
+    return [value_type(value) for value in string.split(',')]
+
+
+def print_summary(results):
+    print('{:>5} {:>7} {:>9} {:>8} {:>9} {:>8} {:>8} {:>10} {:>9}'.format(
+        'level', 'hue', 'intensity', 'position', 'absorbed', 'escaped', 'returned', 'mean v_x', 'T_x (K)'))
+    for result in results:
+        parameters = result['parameters']
+        metrics = result['metrics']
+        histogram = np.array(metrics['exit_velocity_histogram'])
+        bins = np.array(metrics['exit_velocity_bins'])
+        bin_centers = (bins[1:] + bins[:-1])/2
+        mean_velocity = np.sum(histogram*bin_centers)/np.sum(histogram) if np.sum(histogram) > 0 else float('nan')
+        print('{:>5} {:>7.1f} {:>9.2f} {:>8.2f} {:>9} {:>8} {:>8} {:>10.3f} {:>9.1f}'.format(
+            parameters['level'], parameters['hue'], parameters['intensity'], parameters['position'],
+            metrics['photons_absorbed'], metrics['atoms_escaped'], metrics['atoms_returned'], mean_velocity,
+            metrics['temperature'][0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run headless laser cooling simulations over a grid of settings.')
+    parser.add_argument('--levels', default='1,2,3', help='levels to simulate (1-4, 4 is the gas mode)')
+    parser.add_argument('--hues', default='{}:{}:13'.format(HUE_MIN, HUE_MAX), help='laser hues')
+    parser.add_argument('--intensities', default='1', help='laser intensities (0.5-2)')
+    parser.add_argument('--positions', default='0.5', help='laser heights, from 0 (top) to 1 (bottom)')
+    parser.add_argument('--atom-hue', type=float, default=None,
+                        help='hue of the atoms in levels 3 and 4 (default: random)')
+    parser.add_argument('--frames', type=int, default=9000, help='number of physics steps per simulation')
+    parser.add_argument('--seed', type=int, default=0, help='base seed of the random generators')
+    parser.add_argument('--backend', default=HEADLESS_PHYSICS_BACKEND, choices=list(PHYSICS_BACKENDS),
+                        help='how the collisions of the gas mode are computed (default: numba if it is installed)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--output', default=None, help='write all results to this JSON file')
+    arguments = parser.parse_args()
+
+    grid = make_grid(parse_values(arguments.levels, int), parse_values(arguments.hues),
+                     parse_values(arguments.intensities), parse_values(arguments.positions), arguments.frames,
+                     arguments.atom_hue, arguments.seed, arguments.backend)
+    results = run_sweep(grid, arguments.workers)
+    print_summary(results)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1)
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(LaserCooling.__file__)))
+    main()
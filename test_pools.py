@@ -0,0 +1,186 @@
+# Tests for the particle pools and the physics backends of the laser cooling applet
+# By Matthew Houtput (matthew.houtput@uantwerpen.be)
+
+# Run these tests with the Python standard library, from the directory of this file:
+#   python -m unittest test_pools
+# No display is needed. The 'numba' backend is only tested if Numba is installed.
+
+import unittest
+
+import numpy as np
+
+from LaserCooling import (PhotonPool, Simulation, find_hits_numpy, find_reachable_atoms, PHYSICS_BACKENDS,
+                          GAS_LEVEL)
+
+
+def make_pool(capacity, n_particles=None):
+    # A photon pool with the given capacity, with n_particles particles in it (by default, full)
+    pool = PhotonPool(capacity)
+    n_particles = capacity if n_particles is None else n_particles
+    positions = np.zeros((n_particles, 2))
+    pool.add_many(positions, positions, np.zeros(n_particles))
+    return pool
+
+
+class TestParticlePool(unittest.TestCase):
+
+    def assert_consistent(self, pool):
+        # The bookkeeping of a pool after a sweep: nothing is left marked as dead, and the count, the slots in use
+        # and the free list all agree with the particles that are alive
+        alive_slots = np.flatnonzero(pool.alive)
+        self.assertFalse(np.any(pool.dead), 'slots marked as dead after the sweep')
+        self.assertEqual(pool.count, len(alive_slots))
+        self.assertEqual(len(pool), len(alive_slots))
+        np.testing.assert_array_equal(pool.slots(), alive_slots)
+        np.testing.assert_array_equal(np.sort(pool.free_slots[:pool.n_free]), np.flatnonzero(~pool.alive))
+        self.assertEqual(pool.n_free + pool.count, pool.capacity)
+
+    def test_add_fills_lowest_slots_first(self):
+        pool = make_pool(8, 0)
+        self.assertEqual([pool.add((0., 0.), (0., 0.), 0.) for _ in range(3)], [0, 1, 2])
+        np.testing.assert_array_equal(pool.add_many(np.zeros((2, 2)), np.zeros((2, 2)), np.zeros(2)), [3, 4])
+        np.testing.assert_array_equal(pool.ids[pool.slots()], np.arange(5))
+        self.assert_consistent(pool)
+
+    def test_sweep_reuses_freed_slots(self):
+        pool = make_pool(8, 6)
+        pool.mark_dead(np.array([1, 4]))
+        np.testing.assert_array_equal(np.sort(pool.sweep()), [1, 4])
+        self.assert_consistent(pool)
+        # The freed slots are used again before the slots that were never used, and the particles get new ids
+        new_slots = [pool.add((0., 0.), (0., 0.), 0.) for _ in range(3)]
+        self.assertEqual(sorted(new_slots[:2]), [1, 4])
+        self.assertEqual(new_slots[2], 6)
+        np.testing.assert_array_equal(np.sort(pool.ids[new_slots]), [6, 7, 8])
+        self.assert_consistent(pool)
+
+    def test_count_and_high_water(self):
+        pool = make_pool(4, 3)
+        self.assertEqual((pool.count, pool.high_water), (3, 3))
+        pool.remove([0, 2])
+        self.assertEqual((pool.count, pool.high_water, pool.n_removed), (1, 3, 2))
+        pool.add((0., 0.), (0., 0.), 0.)
+        self.assertEqual((pool.count, pool.high_water), (2, 3))
+        # The pool is full after two more particles; the rest are dropped
+        slots = pool.add_many(np.zeros((5, 2)), np.zeros((5, 2)), np.zeros(5))
+        self.assertEqual(len(slots), 2)
+        self.assertEqual(pool.add((0., 0.), (0., 0.), 0.), -1)
+        self.assertEqual(pool.stats(), {'capacity': 4, 'count': 4, 'high_water': 4, 'added': 6, 'removed': 2,
+                                        'dropped': 4})
+        self.assert_consistent(pool)
+
+    def test_marked_particles_stay_until_sweep(self):
+        pool = make_pool(6)
+        pool.velocities[:] = 1.
+        pool.mark_dead(np.array([2, 3]))
+        # The slots are not reused before the sweep, and the dead particles no longer move
+        self.assertEqual(pool.count, 6)
+        self.assertEqual(pool.n_free, 0)
+        self.assertEqual(pool.add((0., 0.), (0., 0.), 0.), -1)
+        np.testing.assert_array_equal(pool.velocities[[2, 3]], 0.)
+        pool.sweep()
+        self.assertEqual(pool.count, 4)
+        self.assert_consistent(pool)
+
+    def test_sweep_after_mixed_kills(self):
+        # Every frame, half of the particles are removed in three overlapping batches (as the absorbed photons, the
+        # photons that left the play area, and again photons that were already removed), and the pool is refilled
+        rng = np.random.default_rng(0)
+        pool = make_pool(1000)
+        for _ in range(20):
+            removed = rng.random(pool.capacity) < 0.5
+            removed_slots = np.flatnonzero(removed)
+            for batch in (removed_slots[::2], removed_slots[1::2], removed_slots[rng.random(len(removed_slots)) < 0.5]):
+                pool.mark_dead(batch)
+            np.testing.assert_array_equal(np.sort(pool.sweep()), removed_slots)
+            np.testing.assert_array_equal(pool.alive, ~removed)
+            self.assert_consistent(pool)
+            pool.add_many(np.zeros((pool.n_free, 2)), np.zeros((pool.n_free, 2)), np.zeros(pool.n_free))
+            self.assertEqual(pool.count, pool.capacity)
+
+    def test_sweep_without_kills(self):
+        pool = make_pool(5, 3)
+        self.assertEqual(len(pool.sweep()), 0)
+        pool.mark_dead(np.array([], dtype=np.intp))
+        self.assertEqual(len(pool.sweep()), 0)
+        self.assertEqual(pool.count, 3)
+        self.assert_consistent(pool)
+
+    def test_clear(self):
+        pool = make_pool(5)
+        pool.mark_dead(np.array([1]))
+        pool.clear()
+        self.assertEqual((pool.count, pool.n_removed, pool.high_water), (0, 5, 5))
+        self.assert_consistent(pool)
+        self.assertEqual(pool.add((0., 0.), (0., 0.), 0.), 0)
+
+
+def run_gas_mode(backend, n_frames, seed=0):
+    # Run the gas mode with the given backend of collide_atoms (see PHYSICS_BACKENDS) for n_frames frames, with the
+    # laser a little redder than the atoms, and return the state of the atoms and the photons after every frame
+    simulation = Simulation(seed=seed)
+    simulation.physics_backend = backend
+    simulation.set_level(GAS_LEVEL, 140.)
+    simulation.set_laser(hue=130., intensity=2.)
+    states = []
+    for _ in range(n_frames):
+        simulation.step()
+        atoms = simulation.atoms
+        photons = simulation.photons
+        atom_slots = atoms.slots()
+        states.append({'photons_absorbed': simulation.n_photons_absorbed,
+                       'atom_slots': atom_slots.copy(),
+                       'atom_positions': atoms.positions[atom_slots].copy(),
+                       'atom_velocities': atoms.velocities[atom_slots].copy(),
+                       'atom_hues': atoms.hues[atom_slots].copy(),
+                       'atom_hues_opposite': atoms.hues_opposite[atom_slots].copy(),
+                       'photon_slots': photons.slots().copy(),
+                       'photon_positions': photons.positions[photons.slots()].copy()})
+    return states
+
+
+class TestPhysicsBackends(unittest.TestCase):
+    # Every backend must find the same hits in the same order as NumPy, so the simulations stay the same in every
+    # frame. The 'python' backend runs the loops of the Numba kernel without compiling them, which is slow, so the
+    # runs are short; the photons reach the atoms in the first frame, and there are hundreds of absorptions.
+    N_FRAMES = 30
+
+    @classmethod
+    def setUpClass(cls):
+        cls.reference_states = run_gas_mode('numpy', cls.N_FRAMES)
+
+    def assert_same_as_numpy(self, backend):
+        states = run_gas_mode(backend, self.N_FRAMES)
+        self.assertGreater(self.reference_states[-1]['photons_absorbed'], 0)
+        for frame, (state, reference_state) in enumerate(zip(states, self.reference_states)):
+            for key, reference_value in reference_state.items():
+                np.testing.assert_array_equal(state[key], reference_value,
+                                              'different {} in frame {}'.format(key, frame + 1))
+
+    def test_python_backend(self):
+        self.assert_same_as_numpy('python')
+
+    @unittest.skipUnless('numba' in PHYSICS_BACKENDS, 'Numba is not installed')
+    def test_numba_backend(self):
+        self.assert_same_as_numpy('numba')
+
+    def test_dormant_atoms_have_no_hits(self):
+        # Looking up only the atoms that find_reachable_atoms returns gives the same hits as looking up all atoms
+        simulation = Simulation(level=GAS_LEVEL, seed=0, atom_hue=140.)
+        simulation.set_laser(hue=130., intensity=2.)
+        atoms = simulation.atoms
+        photons = simulation.photons
+        n_dormant = 0
+        for _ in range(self.N_FRAMES):
+            simulation.step()
+            photons.move()
+            atom_slots = find_reachable_atoms(atoms, photons)
+            n_dormant += atoms.count - len(atom_slots)
+            for array, reference_array in zip(find_hits_numpy(atoms, photons, True, atom_slots),
+                                              find_hits_numpy(atoms, photons, True)):
+                np.testing.assert_array_equal(array, reference_array)
+        self.assertGreater(n_dormant, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
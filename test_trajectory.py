@@ -0,0 +1,56 @@
+# Tests for the trajectory export of the laser cooling applet
+# By Matthew Houtput (matthew.houtput@uantwerpen.be)
+
+# Run these tests with the Python standard library, from the directory of this file:
+#   python -m unittest test_trajectory
+# No display is needed.
+
+import tempfile
+import unittest
+
+import numpy as np
+
+from LaserCooling import Simulation, TrajectoryWriter, load_trajectory, GAS_LEVEL
+
+
+def record_gas_mode(directory, n_frames, seed=0):
+    # Run the gas mode for n_frames frames, and save the atoms after every frame and all absorptions to directory
+    simulation = Simulation(seed=seed)
+    simulation.set_level(GAS_LEVEL, 140.)
+    simulation.set_laser(hue=130., intensity=2.)
+    simulation.trajectory_writer = TrajectoryWriter(directory)
+    simulation.step(n_frames)
+    simulation.trajectory_writer.close()
+    return simulation
+
+
+class TestTrajectoryWriter(unittest.TestCase):
+
+    def test_absorptions_match_atom_records(self):
+        # An absorption record has the frame of the step in which the photon was absorbed, like the atom records
+        # that are saved at the end of that step: the position and the velocity (after the kick) of the absorbing
+        # atom are the same in both, unless the atom bounced off a wall in the same step
+        with tempfile.TemporaryDirectory() as directory:
+            simulation = record_gas_mode(directory, 60)
+            atoms = np.concatenate(load_trajectory(directory, 'atoms'))
+            absorptions = np.concatenate(load_trajectory(directory, 'absorptions'))
+        self.assertEqual(len(absorptions), simulation.n_photons_absorbed)
+        self.assertGreater(len(absorptions), 0)
+        self.assertTrue(np.all((1 <= absorptions['frame']) & (absorptions['frame'] <= simulation.frame)))
+        # Find the atom record of every absorption by its frame and its id
+        n_ids = simulation.atoms.next_id
+        atom_keys = atoms['frame']*n_ids + atoms['id']
+        order = np.argsort(atom_keys)
+        matches = order[np.searchsorted(atom_keys, absorptions['frame']*n_ids + absorptions['atom_id'],
+                                        sorter=order)]
+        matched_atoms = atoms[matches]
+        np.testing.assert_array_equal(matched_atoms['frame'], absorptions['frame'])
+        np.testing.assert_array_equal(matched_atoms['id'], absorptions['atom_id'])
+        not_bounced = (matched_atoms['x'] == absorptions['x']) & (matched_atoms['y'] == absorptions['y'])
+        self.assertGreater(np.count_nonzero(not_bounced), 0.9*len(absorptions))
+        for key in ('vx', 'vy'):
+            np.testing.assert_array_equal(matched_atoms[key][not_bounced], absorptions[key][not_bounced], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+# Classroom wall for the laser cooling applet
+# By Matthew Houtput (matthew.houtput@uantwerpen.be)
+
+# Shows several copies of the applet side by side in one window, every one with its own laser settings, e.g. to
+# compare a red-detuned, a resonant and a blue-detuned laser in level 3:
+#   python wall.py --level 3 --atom-hue 140 --hues 110,140,170
+#   python wall.py --level 3 --atom-hue 140 --hues 110,140,170 --intensities 0.5,2
+# There is one tile for every combination of a laser hue and an intensity. All tiles use the same seed, so the same
+# atoms come in everywhere, and only the lasers differ. The tiles run in one process: they share pygame, NumPy, the
+# images, the fonts and the color table, and all simulations are stepped together by one SimulationBatch. The mouse
+# works on the tile it is over, so the controls of every tile can still be used.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+
+# pygame reads these environment variables when it is imported, so the imports below have to come after them
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame  # noqa: E402
+from pygame.locals import *  # noqa: E402
+
+import LaserCooling  # noqa: E402
+from LaserCooling import (Simulation, SimulationBatch, ControlPanel, Renderer, ASSETS, TEXT_CACHE, FONT_SIZE_NORMAL,
+                          FONT_SIZE_LARGE, WINDOW_WIDTH, WINDOW_HEIGHT, LEFT_BORDER, TOP_BORDER, WHITE, DARK_GRAY,
+                          GAS_LEVEL, N_LEVELS, RENDER_FPS, PHYSICS_TIMESTEP, MAX_FRAME_TIME)  # noqa: E402
+
+
+# ===== TILES =====
+# The scale of the tiles is a multiple of 1/SCALE_STEPS; the width and height of the applet are multiples of it
+SCALE_STEPS = 8
+
+
+class Tile:
+    # One copy of the applet: its simulation and controls, drawn on its own surface of the full applet size, which
+    # is then scaled down to the rectangle 'rect' of the window
+
+    def __init__(self, rect, level, laser_hue, laser_intensity, atom_hue, seed, fonts):
+        font_normal, font_large = fonts
+        self.rect = rect
+        self.font = font_normal
+        self.surface = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT))
+        self.controls = ControlPanel(self.surface, font_normal)
+        self.controls.slider_hue.set_slider_value(laser_hue)
+        self.controls.slider_intensity.set_slider_value(laser_intensity)
+        self.renderer = Renderer(self.surface, font_large, font_normal)
+        self.renderer.update_display = False
+        self.simulation = Simulation(seed=seed)
+        self.simulation.set_level(level, atom_hue)
+        self.overlay = None
+        self.overlay_settings = None
+
+    def get_overlay(self):
+        # The settings of the tile, shown in the top left corner of the play area. They are rendered again whenever
+        # they change: the laser can be set in every tile, and a restart or a new level picks a new atom hue.
+        simulation = self.simulation
+        atom_hue = simulation.hsv_color[0] if simulation.hsv_color is not None else None
+        settings = (simulation.laser_hue, self.controls.slider_intensity.get_slider_value(), atom_hue)
+        if settings != self.overlay_settings:
+            label = 'Laser hue {:.0f}, intensity {:.1f}'.format(*settings[:2])
+            if atom_hue is not None:
+                label += ', atom hue {:.0f}'.format(atom_hue)
+            text = TEXT_CACHE.render(self.font, label, WHITE)
+            label_image = pygame.Surface((text.get_width() + 8, text.get_height() + 4))
+            label_image.fill(DARK_GRAY)
+            label_image.blit(text, (4, 2))
+            self.overlay = (label_image, (LEFT_BORDER + 4, TOP_BORDER + 4))
+            self.overlay_settings = settings
+            self.renderer.invalidate()  # The old label may be wider than the new one
+        return self.overlay
+
+    def get_mouse_state(self, mouse_state):
+        # The mouse state in the coordinates of the tile; if the mouse is not over the tile, it is not pressed
+        (mouse_x, mouse_y), mouse_is_clicked, mouse_is_down = mouse_state
+        if not self.rect.collidepoint(mouse_x, mouse_y):
+            return (-1, -1), False, False
+        return ((int((mouse_x - self.rect.x)*WINDOW_WIDTH/self.rect.width),
+                 int((mouse_y - self.rect.y)*WINDOW_HEIGHT/self.rect.height)), mouse_is_clicked, mouse_is_down)
+
+    def draw(self, window, mouse_state, alpha):
+        # Draw the tile on its own surface, and copy the parts that changed to the window
+        # Returns the list of rectangles of the window that changed
+        simulation = self.simulation
+        dirty_rects = self.renderer.draw(simulation, simulation.level, self.controls.visible_widgets(simulation.level),
+                                         mouse_state, alpha, self.get_overlay())
+        if self.rect.size == self.surface.get_size():
+            window_rects = [rect.move(self.rect.topleft) for rect in dirty_rects]
+            for rect, window_rect in zip(dirty_rects, window_rects):
+                window.blit(self.surface, window_rect, rect)
+            return window_rects
+        # Only the parts that changed are scaled down. The scale of a tile is a multiple of 1/SCALE_STEPS (see
+        # get_scale), so a block of SCALE_STEPS x SCALE_STEPS pixels of the tile becomes a whole number of pixels of
+        # the window; the parts are widened to whole blocks, and then look the same as if the whole tile was scaled.
+        scale_steps = self.rect.width*SCALE_STEPS//WINDOW_WIDTH
+        surface_rect = self.surface.get_rect()
+        window_rects = []
+        for rect in dirty_rects:
+            left, top = SCALE_STEPS*(rect.left//SCALE_STEPS), SCALE_STEPS*(rect.top//SCALE_STEPS)
+            right, bottom = -SCALE_STEPS*(-rect.right//SCALE_STEPS), -SCALE_STEPS*(-rect.bottom//SCALE_STEPS)
+            rect = pygame.Rect(left, top, right - left, bottom - top).clip(surface_rect)
+            window_rect = pygame.Rect(self.rect.x + rect.x*scale_steps//SCALE_STEPS,
+                                      self.rect.y + rect.y*scale_steps//SCALE_STEPS,
+                                      rect.width*scale_steps//SCALE_STEPS, rect.height*scale_steps//SCALE_STEPS)
+            if window_rect.width > 0 and window_rect.height > 0:
+                pygame.transform.smoothscale(self.surface.subsurface(rect), window_rect.size,
+                                             window.subsurface(window_rect))
+                window_rects.append(window_rect)
+        return window_rects
+
+
+def parse_values(string):
+    return [float(value) for value in string.split(',')]
+
+
+def get_scale(scale):
+    # Round the scale of the tiles down to a multiple of 1/SCALE_STEPS, between 1/SCALE_STEPS and 1
+    return min(max(int(scale*SCALE_STEPS), 1), SCALE_STEPS)/SCALE_STEPS
+
+
+# ===== MAIN FUNCTION =====
+def main():
+    parser = argparse.ArgumentParser(description='Show several copies of the laser cooling applet side by side.')
+    parser.add_argument('--level', type=int, default=3, help='level of all tiles (1-{})'.format(N_LEVELS))
+    parser.add_argument('--hues', default='110,140,170', help='laser hues, separated by commas')
+    parser.add_argument('--intensities', default='1', help='laser intensities (0.5-2), separated by commas')
+    parser.add_argument('--atom-hue', type=float, default=None,
+                        help='hue of the atoms in levels 3 and 4 (default: random, the same in all tiles)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of all simulations (default: random)')
+    parser.add_argument('--columns', type=int, default=None, help='number of tiles next to each other')
+    parser.add_argument('--scale', type=float, default=None,
+                        help='size of a tile, rounded down to a multiple of 1/{} (default: fit the screen)'.format(
+                            SCALE_STEPS))
+    arguments = parser.parse_args()
+    if not 1 <= arguments.level <= N_LEVELS:
+        parser.error('the level should be between 1 and {}'.format(N_LEVELS))
+    settings = list(itertools.product(parse_values(arguments.hues), parse_values(arguments.intensities)))
+    seed = arguments.seed if arguments.seed is not None else random.getrandbits(63)
+    atom_hue = arguments.atom_hue
+    if atom_hue is None and arguments.level in (3, GAS_LEVEL):
+        atom_hue = int(random.uniform(80, 240))
+
+    # The tiles are as large as possible while the whole wall fits on the screen, but never larger than the applet
+    pygame.init()
+    n_columns = arguments.columns or min(len(settings), 3)
+    n_rows = (len(settings) + n_columns - 1)//n_columns
+    scale = arguments.scale
+    if scale is None:
+        display_info = pygame.display.Info()
+        scale = min(1., 0.95*display_info.current_w/(n_columns*WINDOW_WIDTH),
+                    0.9*display_info.current_h/(n_rows*WINDOW_HEIGHT))
+    scale = get_scale(scale)
+    tile_size = (int(scale*WINDOW_WIDTH), int(scale*WINDOW_HEIGHT))
+    window = pygame.display.set_mode((n_columns*tile_size[0], n_rows*tile_size[1]))
+    pygame.display.set_caption('Laser cooling')
+    fonts = (ASSETS.get_font(FONT_SIZE_NORMAL), ASSETS.get_font(FONT_SIZE_LARGE))
+    tiles = [Tile(pygame.Rect(((i % n_columns)*tile_size[0], (i//n_columns)*tile_size[1]), tile_size),
+                  arguments.level, laser_hue, laser_intensity, atom_hue, seed, fonts)
+             for i, (laser_hue, laser_intensity) in enumerate(settings)]
+    batch = SimulationBatch([tile.simulation for tile in tiles])
+
+    # The same main loop as the applet (see LaserCooling.main), for all tiles at once
+    fps_clock = pygame.time.Clock()
+    mouse_xy = (0, 0)
+    mouse_is_down = False
+    time_accumulator = 0.
+    fps_clock.tick()
+    while True:
+        mouse_is_clicked = False
+        for event in pygame.event.get():
+            if event.type == QUIT or (event.type == KEYUP and event.key == K_ESCAPE):
+                pygame.quit()
+                sys.exit()
+            elif event.type == MOUSEMOTION:
+                mouse_xy = event.pos
+            elif event.type == MOUSEBUTTONDOWN and event.button == 1:
+                mouse_xy = event.pos
+                mouse_is_down = True
+                mouse_is_clicked = True
+            elif event.type == MOUSEBUTTONUP and event.button == 1:
+                mouse_xy = event.pos
+                mouse_is_clicked = False
+                mouse_is_down = False
+        mouse_state = (mouse_xy, mouse_is_clicked, mouse_is_down)
+
+        dirty_rects = []
+        for tile in tiles:
+            tile_mouse_state = tile.get_mouse_state(mouse_state)
+            tile.controls.update(tile_mouse_state, tile.simulation)
+            dirty_rects += tile.draw(window, tile_mouse_state, time_accumulator/PHYSICS_TIMESTEP)
+        pygame.display.update(dirty_rects)
+
+        time_accumulator += min(fps_clock.tick(RENDER_FPS), MAX_FRAME_TIME)
+        n_steps = int(time_accumulator // PHYSICS_TIMESTEP)
+        time_accumulator -= n_steps*PHYSICS_TIMESTEP
+        batch.step(n_steps)
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(LaserCooling.__file__)))
+    main()